@@ -0,0 +1,574 @@
+
+# storage backends: the job lifecycle api the workers and the broker program against
+
+import fnmatch
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Protocol
+
+import storage
+
+
+# what a storage backend has to provide
+# job rows are (id, command, state, attempts, max_retires, created_at, updated_at)
+# claimed jobs are dicts with id, command, attempts, max_retires
+class StorageBackend(Protocol):
+    name: str
+
+    # returns the number of duplicate external ids a migration cleared
+    def make_db(self) -> int | None: ...
+
+    # enqueue and job reads
+    def add_job(self, command, state='pending', max_retires=3, external_id=None, on_conflict='return') -> int | None: ...
+    def add_jobs(self, jobs, on_conflict='return') -> list: ...
+    def get_job(self, job_id: int): ...
+    def get_job_by_external_id(self, external_id: str): ...
+    def list_jobs(self, state=None) -> list: ...
+    def counts_by_state(self) -> dict: ...
+    def count_pending(self) -> int: ...
+    def shard_for_key(self, key: str) -> int: ...
+
+    # claim and transitions
+    def next_job(self, shard_hint: int = 0) -> dict | None: ...
+    def claim_jobs(self, worker_id: str, limit: int = 1, lease_seconds: int = 30, shard_hint: int = 0) -> list: ...
+    def extend_leases(self, worker_id: str, job_ids, lease_seconds: int = 30) -> int: ...
+    # with an owner these only act on a job still leased to that worker and return False otherwise
+    def mark_complete(self, job_id: int, owner: str | None = None) -> bool: ...
+    def mark_dead(self, job_id: int, owner: str | None = None) -> bool: ...
+    def requeue_with_attempt(self, job_id: int, next_attempts: int, owner: str | None = None) -> bool: ...
+    def release_jobs(self, job_ids, owner: str) -> int: ...
+    def retry_dead(self, job_id: int) -> bool: ...
+
+    # dead letter queue (since: went dead at or after, match: a glob on the command)
+    def retry_dead_by_identifier(self, identifier: str) -> bool: ...
+    def iter_dead_jobs(self, since=None, match=None): ...
+    def count_dead(self, since=None, match=None) -> int: ...
+    def retry_dead_jobs(self, since=None, match=None) -> int: ...
+    def purge_dead(self, since=None, match=None) -> int: ...
+
+    # events
+    def add_event(self, job_id: int, event: str, worker=None, attempt=None, delay=None, exit_code=None, upstream=None) -> None: ...
+    def add_events(self, events) -> None: ...
+    def list_events(self, job_id=None, limit=100, since=None, until=None, order='desc') -> list: ...
+
+    # result cache
+    def cache_get(self, key: str): ...
+    def cache_put(self, key: str, exit_code: int, output: str | None, ttl: int) -> None: ...
+    def cache_stats(self) -> dict: ...
+    def cache_clear(self) -> int: ...
+
+    # config
+    def get_config(self, key: str, default: str | None = None): ...
+    def set_config(self, key: str, value: str) -> None: ...
+
+    # workers
+    def register_worker(self, worker_id: str, pid: int) -> int: ...
+    def worker_number(self, worker_id: str) -> int: ...
+    def timestamp_worker(self, worker_id: str, status: str = 'running') -> None: ...
+    def count_active_workers(self, threshold_seconds: int = 10) -> int: ...
+
+
+# the sqlite backend is the storage module itself (queuectl.db and its shards)
+class SqliteBackend:
+    name = 'sqlite'
+
+    make_db = staticmethod(storage.make_db)
+    add_job = staticmethod(storage.add_job)
+    add_jobs = staticmethod(storage.add_jobs)
+    get_job = staticmethod(storage.get_job)
+    get_job_by_external_id = staticmethod(storage.get_job_by_external_id)
+    list_jobs = staticmethod(storage.list_jobs)
+    counts_by_state = staticmethod(storage.counts_by_state)
+    count_pending = staticmethod(storage.count_pending)
+    shard_for_key = staticmethod(storage.shard_for_key)
+    next_job = staticmethod(storage.next_job)
+    claim_jobs = staticmethod(storage.claim_jobs)
+    extend_leases = staticmethod(storage.extend_leases)
+    mark_complete = staticmethod(storage.mark_complete)
+    mark_dead = staticmethod(storage.mark_dead)
+    requeue_with_attempt = staticmethod(storage.requeue_with_attempt)
+    release_jobs = staticmethod(storage.release_jobs)
+    retry_dead = staticmethod(storage.retry_dead)
+    retry_dead_by_identifier = staticmethod(storage.retry_dead_by_identifier)
+    iter_dead_jobs = staticmethod(storage.iter_dead_jobs)
+    count_dead = staticmethod(storage.count_dead)
+    retry_dead_jobs = staticmethod(storage.retry_dead_jobs)
+    purge_dead = staticmethod(storage.purge_dead)
+    add_event = staticmethod(storage.add_event)
+    add_events = staticmethod(storage.add_events)
+    list_events = staticmethod(storage.list_events)
+    cache_get = staticmethod(storage.cache_get)
+    cache_put = staticmethod(storage.cache_put)
+    cache_stats = staticmethod(storage.cache_stats)
+    cache_clear = staticmethod(storage.cache_clear)
+    get_config = staticmethod(storage.get_config)
+    set_config = staticmethod(storage.set_config)
+    register_worker = staticmethod(storage.register_worker)
+    timestamp_worker = staticmethod(storage.timestamp_worker)
+    worker_number = staticmethod(storage.worker_number)
+    count_active_workers = staticmethod(storage.count_active_workers)
+
+
+# function to format a timestamp the way sqlite's CURRENT_TIMESTAMP does
+# (the string only changes once a second, so it is cached)
+_stamp = (0, '')
+
+
+def _now() -> str:
+    global _stamp
+    sec = int(time.time())
+    if _stamp[0] != sec:
+        _stamp = (sec, time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(sec)))
+    return _stamp[1]
+
+
+# in-memory backend: everything lives in dicts and heaps behind one lock.
+# nothing is persisted, so it is meant for `queuectl serve --backend memory`,
+# tests and benchmarks rather than for jobs that must survive a restart.
+class MemoryBackend:
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._event_ids = itertools.count(1)
+        self._jobs = {}             # id -> job dict
+        self._external = {}         # external_id -> id
+        self._pending = []          # heap of (seq, id), stale entries are skipped on pop
+        self._leases = []           # heap of (expires, id), stale entries are skipped on pop
+        self._counts = {'pending': 0, 'blocked': 0, 'processing': 0, 'completed': 0, 'failed': 0, 'dead': 0}
+        self._dependents = {}       # upstream id -> list of dependent ids
+        self._events = []           # (id, job_id, event, worker number, attempt, delay, exit_code, upstream, created_at)
+        self._events_by_job = {}    # job_id -> list of events
+        self._cache = OrderedDict()  # key -> [exit_code, output, expires, hits], least recently used first
+        self._config = {}
+        self._workers = {}          # worker_id -> {'num', 'pid', 'started_at', 'last_heartbeat', 'status'}
+        self._worker_names = {}     # num -> worker_id
+
+    def make_db(self):
+        return 0
+
+    def shard_for_key(self, key):
+        return 0
+
+    # function to move a job to a new state and keep the counters and heaps in sync
+    def _set_state(self, job, state):
+        self._counts[job['state']] -= 1
+        self._counts[state] = self._counts.get(state, 0) + 1
+        job['state'] = state
+        job['updated_at'] = _now()
+        job.pop('lease_owner', None)
+        job.pop('lease_expires', None)
+        if state == 'pending':
+            heapq.heappush(self._pending, (job['seq'], job['id']))
+
+    @staticmethod
+    def _row(job):
+        return (job['id'], job['command'], job['state'], job['attempts'], job['max_retires'], job['created_at'], job['updated_at'])
+
+    @staticmethod
+    def _claimed(job):
+        return {
+            'id': job['id'], 'command': job['command'], 'attempts': job['attempts'],
+            'max_retires': job['max_retires'], 'cache_ttl': job.get('cache_ttl'), 'limits': job.get('limits'),
+        }
+
+    def add_job(self, command, state='pending', max_retires=3, external_id=None, on_conflict='return'):
+        job = {'command': command, 'state': state, 'max_retires': max_retires, 'external_id': external_id}
+        return self.add_jobs([job], on_conflict)[0][0]
+
+    def add_jobs(self, jobs, on_conflict='return'):
+        if on_conflict not in ('return', 'update'):
+            raise ValueError('on_conflict must be one of: return, update')
+        results = []
+        with self._lock:
+            # check every dependency first so a bad batch adds nothing
+            known = set()
+            for spec in jobs:
+                for dep in spec.get('depends_on') or ():
+                    if not (dep in self._jobs if isinstance(dep, int) else (dep in self._external or dep in known)):
+                        raise ValueError(f'unknown dependency {dep!r}')
+                if spec.get('external_id') is not None:
+                    known.add(spec['external_id'])
+            cascade = self._config.get('dependency_failure') == 'cascade'
+            for spec in jobs:
+                external_id = spec.get('external_id')
+                existing = self._jobs.get(self._external.get(external_id)) if external_id is not None else None
+                if existing:
+                    if on_conflict == 'update':
+                        existing['command'] = spec['command']
+                        existing['max_retires'] = spec.get('max_retires', 3)
+                        existing['cache_ttl'] = spec.get('cache_ttl')
+                        existing['limits'] = spec.get('limits')
+                        existing['updated_at'] = _now()
+                    results.append((existing['id'], False))
+                    continue
+                job_id = next(self._ids)
+                # upstream jobs that are not completed yet block the new job
+                waiting = {}
+                for dep in spec.get('depends_on') or ():
+                    upstream = self._jobs[dep if isinstance(dep, int) else self._external[dep]]
+                    if upstream['state'] != 'completed':
+                        waiting[upstream['id']] = upstream['state']
+                state = spec.get('state') or 'pending'
+                if waiting and state == 'pending':
+                    state = 'dead' if cascade and 'dead' in waiting.values() else 'blocked'
+                for dep_id in waiting:
+                    self._dependents.setdefault(dep_id, []).append(job_id)
+                now = _now()
+                self._jobs[job_id] = {
+                    'id': job_id, 'command': spec['command'], 'state': state, 'attempts': 0,
+                    'max_retires': spec.get('max_retires', 3), 'created_at': now, 'updated_at': now,
+                    'external_id': external_id, 'seq': job_id, 'remaining': len(waiting),
+                    'cache_ttl': spec.get('cache_ttl'), 'limits': spec.get('limits'),
+                }
+                self._counts[state] = self._counts.get(state, 0) + 1
+                if external_id is not None:
+                    self._external[external_id] = job_id
+                if state == 'pending':
+                    heapq.heappush(self._pending, (job_id, job_id))
+                results.append((job_id, True))
+        return results
+
+    def get_job(self, job_id):
+        with self._lock:
+            job = self._jobs.get(int(job_id))
+            return self._row(job) if job else None
+
+    def get_job_by_external_id(self, external_id):
+        with self._lock:
+            job = self._jobs.get(self._external.get(external_id))
+            return self._row(job) if job else None
+
+    def list_jobs(self, state=None):
+        with self._lock:
+            return [self._row(j) for j in self._jobs.values() if not state or j['state'] == state]
+
+    def counts_by_state(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def count_pending(self):
+        return self._counts['pending']
+
+    # function to pop the oldest pending job, or None
+    def _pop_pending(self):
+        while self._pending:
+            _, job_id = heapq.heappop(self._pending)
+            job = self._jobs.get(job_id)
+            if job and job['state'] == 'pending':
+                return job
+        return None
+
+    # function to put jobs with an expired lease back to pending
+    def _expire_leases(self):
+        now = time.time()
+        while self._leases and self._leases[0][0] < now:
+            expires, job_id = heapq.heappop(self._leases)
+            job = self._jobs.get(job_id)
+            if job and job['state'] == 'processing' and job.get('lease_expires') == expires:
+                self._set_state(job, 'pending')
+
+    def next_job(self, shard_hint=0):
+        with self._lock:
+            job = self._pop_pending()
+            if not job:
+                return None
+            self._set_state(job, 'processing')
+            return self._claimed(job)
+
+    def claim_jobs(self, worker_id, limit=1, lease_seconds=30, shard_hint=0):
+        with self._lock:
+            self._expire_leases()
+            expires = time.time() + lease_seconds
+            jobs = []
+            while len(jobs) < limit:
+                job = self._pop_pending()
+                if not job:
+                    break
+                self._set_state(job, 'processing')
+                job['lease_owner'] = worker_id
+                job['lease_expires'] = expires
+                heapq.heappush(self._leases, (expires, job['id']))
+                jobs.append(self._claimed(job))
+            return jobs
+
+    def extend_leases(self, worker_id, job_ids, lease_seconds=30):
+        with self._lock:
+            expires = time.time() + lease_seconds
+            ids = [int(j) for j in job_ids if self._owned(j, worker_id)]
+            for job_id in ids:
+                self._jobs[job_id]['lease_expires'] = expires
+                heapq.heappush(self._leases, (expires, job_id))
+            return len(ids)
+
+    # function to check that a job is still leased to `owner` (no owner: always)
+    def _owned(self, job_id, owner):
+        job = self._jobs.get(int(job_id))
+        return job is not None and (owner is None or (job['state'] == 'processing' and job.get('lease_owner') == owner))
+
+    # completing a job releases its dependents under the same lock
+    def mark_complete(self, job_id, owner=None):
+        with self._lock:
+            job_id = int(job_id)
+            if not self._owned(job_id, owner):
+                return False
+            self._set_state(self._jobs[job_id], 'completed')
+            for dep_id in self._dependents.pop(job_id, ()):
+                dependent = self._jobs.get(dep_id)
+                if dependent is None:
+                    continue
+                dependent['remaining'] = max(dependent['remaining'] - 1, 0)
+                if dependent['remaining'] == 0 and dependent['state'] == 'blocked':
+                    self._set_state(dependent, 'pending')
+                    self._add_event(dep_id, 'ready', upstream=job_id)
+            return True
+
+    # with the 'cascade' dependency rule every blocked job downstream goes dead too
+    def mark_dead(self, job_id, owner=None):
+        with self._lock:
+            job_id = int(job_id)
+            if not self._owned(job_id, owner):
+                return False
+            self._set_state(self._jobs[job_id], 'dead')
+            if self._config.get('dependency_failure') == 'cascade':
+                self._cascade_dead(self._dependents.get(job_id, ()), job_id)
+            return True
+
+    # function to move blocked jobs, and the blocked jobs downstream of them, to dead
+    def _cascade_dead(self, job_ids, upstream):
+        frontier = list(job_ids)
+        while frontier:
+            dependent = self._jobs.get(frontier.pop())
+            if dependent is not None and dependent['state'] == 'blocked':
+                self._set_state(dependent, 'dead')
+                self._add_event(dependent['id'], 'dead', upstream=upstream)
+                frontier.extend(self._dependents.get(dependent['id'], ()))
+
+    def requeue_with_attempt(self, job_id, next_attempts, owner=None):
+        with self._lock:
+            if not self._owned(job_id, owner):
+                return False
+            job = self._jobs[int(job_id)]
+            job['attempts'] = next_attempts
+            self._set_state(job, 'pending')
+            return True
+
+    def release_jobs(self, job_ids, owner):
+        with self._lock:
+            owned = [int(j) for j in job_ids if self._owned(j, owner)]
+            for job_id in owned:
+                self._set_state(self._jobs[job_id], 'pending')
+            return len(owned)
+
+    def retry_dead(self, job_id):
+        with self._lock:
+            job = self._jobs.get(int(job_id))
+            if not job or job['state'] != 'dead':
+                return False
+            job['attempts'] = 0
+            self._set_state(job, 'blocked' if job['remaining'] else 'pending')
+            return True
+
+    def retry_dead_by_identifier(self, identifier):
+        identifier = str(identifier)
+        job_id = int(identifier) if identifier.isdigit() else self._external.get(identifier)
+        return job_id is not None and self.retry_dead(job_id)
+
+    # function to select the dead jobs a dlq operation acts on, newest first
+    def _dead(self, since, match):
+        since = storage.format_timestamp(storage.parse_timestamp(since)) if since else None
+        jobs = [
+            j for j in self._jobs.values()
+            if j['state'] == 'dead' and (since is None or j['updated_at'] >= since)
+            and (not match or fnmatch.fnmatchcase(j['command'], match))
+        ]
+        jobs.sort(key=lambda j: (j['updated_at'], j['id']), reverse=True)
+        return jobs
+
+    def iter_dead_jobs(self, since=None, match=None):
+        with self._lock:
+            rows = [
+                (j['id'], j['external_id'], j['command'], j['attempts'], j['max_retires'], j['created_at'], j['updated_at'])
+                for j in self._dead(since, match)
+            ]
+        return iter(rows)
+
+    def count_dead(self, since=None, match=None):
+        with self._lock:
+            return len(self._dead(since, match))
+
+    def retry_dead_jobs(self, since=None, match=None):
+        with self._lock:
+            jobs = self._dead(since, match)
+            for job in jobs:
+                job['attempts'] = 0
+                self._set_state(job, 'blocked' if job['remaining'] else 'pending')
+                self._add_event(job['id'], 'dlq_retry')
+            return len(jobs)
+
+    # jobs still blocked on a purged job go to the dlq themselves, like in sqlite
+    def purge_dead(self, since=None, match=None):
+        with self._lock:
+            jobs = self._dead(since, match)
+            purged = {j['id'] for j in jobs}
+            for job in jobs:
+                del self._jobs[job['id']]
+                self._counts['dead'] -= 1
+                if job['external_id'] is not None:
+                    self._external.pop(job['external_id'], None)
+                self._events_by_job.pop(job['id'], None)
+            self._events = [e for e in self._events if e[1] not in purged]
+            for job in jobs:
+                dependents = self._dependents.pop(job['id'], ())
+                for dep_id in dependents:
+                    dependent = self._jobs.get(dep_id)
+                    if dependent is not None:
+                        dependent['remaining'] = max(dependent['remaining'] - 1, 0)
+                self._cascade_dead(dependents, job['id'])
+            return len(jobs)
+
+    def add_event(self, job_id, event, worker=None, attempt=None, delay=None, exit_code=None, upstream=None):
+        with self._lock:
+            self._add_event(job_id, event, worker, attempt, delay, exit_code, upstream)
+
+    def _add_event(self, job_id, event, worker=None, attempt=None, delay=None, exit_code=None, upstream=None):
+        if event not in storage.EVENT_CODES:
+            raise ValueError(f'unknown event {event!r}')
+        row = (next(self._event_ids), job_id, event, worker, attempt, delay, exit_code, upstream, int(time.time()))
+        self._events.append(row)
+        self._events_by_job.setdefault(job_id, []).append(row)
+
+    def add_events(self, events):
+        with self._lock:
+            for ev in events:
+                self._add_event(*ev)
+
+    def list_events(self, job_id=None, limit=100, since=None, until=None, order='desc'):
+        since = storage.parse_timestamp(since) if since else None
+        until = storage.parse_timestamp(until) if until else None
+        with self._lock:
+            rows = self._events_by_job.get(job_id, []) if job_id is not None else self._events
+            rows = [r for r in rows if (since is None or r[8] >= since) and (until is None or r[8] <= until)]
+            names = dict(self._worker_names)
+        # events are appended in time order, so the id order is the created_at order
+        if str(order).lower() != 'asc':
+            rows.reverse()
+        if isinstance(limit, int) and limit > 0:
+            rows = rows[:limit]
+        return [r[:3] + (names.get(r[3], r[3]),) + r[4:8] + (storage.format_timestamp(r[8]),) for r in rows]
+
+    def cache_get(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry and entry[2] > time.time():
+                self._cache.move_to_end(key)
+                entry[3] += 1
+                return entry[0], entry[1]
+            return None
+
+    def cache_put(self, key, exit_code, output, ttl):
+        with self._lock:
+            now = time.time()
+            self._cache[key] = [exit_code, output, now + ttl, 0]
+            self._cache.move_to_end(key)
+            for k in [k for k, v in self._cache.items() if v[2] <= now]:
+                del self._cache[k]
+            max_entries = int(self._config.get('cache_max_entries', storage.DEFAULT_CACHE_MAX_ENTRIES))
+            while len(self._cache) > max_entries:
+                self._cache.popitem(last=False)
+
+    def cache_stats(self):
+        with self._lock:
+            now = time.time()
+            return {
+                'entries': len(self._cache),
+                'live': sum(1 for v in self._cache.values() if v[2] > now),
+                'hits': sum(v[3] for v in self._cache.values()),
+                'max_entries': int(self._config.get('cache_max_entries', storage.DEFAULT_CACHE_MAX_ENTRIES)),
+            }
+
+    def cache_clear(self):
+        with self._lock:
+            removed = len(self._cache)
+            self._cache.clear()
+            return removed
+
+    def get_config(self, key, default=None):
+        with self._lock:
+            return self._config.get(key, default)
+
+    def set_config(self, key, value):
+        with self._lock:
+            self._config[key] = value
+
+    def register_worker(self, worker_id, pid):
+        with self._lock:
+            worker = self._worker(worker_id)
+            worker.update(pid=pid, last_heartbeat=time.time(), status='running')
+            return worker['num']
+
+    def worker_number(self, worker_id):
+        with self._lock:
+            return self._worker(worker_id)['num']
+
+    def _worker(self, worker_id):
+        worker = self._workers.get(worker_id)
+        if worker is None:
+            num = len(self._workers) + 1
+            worker = self._workers[worker_id] = {'num': num, 'started_at': _now(), 'last_heartbeat': 0, 'status': None}
+            self._worker_names[num] = worker_id
+        return worker
+
+    def timestamp_worker(self, worker_id, status='running'):
+        with self._lock:
+            worker = self._workers.get(worker_id)
+            if worker:
+                worker.update(last_heartbeat=time.time(), status=status)
+
+    def count_active_workers(self, threshold_seconds=10):
+        with self._lock:
+            cutoff = time.time() - threshold_seconds
+            return sum(1 for w in self._workers.values() if w['status'] == 'running' and w['last_heartbeat'] >= cutoff)
+
+
+BACKENDS = {'sqlite': SqliteBackend, 'memory': MemoryBackend}
+
+_instances = {}
+_default = None
+
+
+# function to get a backend by name; without a name the process-wide default is
+# used, chosen once from QUEUECTL_BACKEND, then the 'backend' config key, then sqlite
+def get_backend(name: str | None = None):
+    global _default
+    if name is None:
+        if _default is None:
+            _default = get_backend(_configured_name())
+        return _default
+    if name not in BACKENDS:
+        raise ValueError(f"unknown backend {name!r} (expected one of: {', '.join(BACKENDS)})")
+    if name not in _instances:
+        _instances[name] = BACKENDS[name]()
+    return _instances[name]
+
+
+def _configured_name() -> str:
+    name = os.environ.get('QUEUECTL_BACKEND')
+    if name:
+        return name
+    try:
+        return storage.get_config('backend', 'sqlite') or 'sqlite'
+    except Exception:
+        return 'sqlite'
+
+
+# function to set the process-wide default backend (by name or instance)
+def set_backend(backend):
+    global _default
+    _default = get_backend(backend) if isinstance(backend, str) else backend
+    return _default
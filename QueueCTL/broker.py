@@ -0,0 +1,487 @@
+
+# network broker: one process owns the storage backend and serves workers over tcp
+
+import hmac
+import ipaddress
+import json
+import os
+import select
+import socket
+import socketserver
+import threading
+import time
+import uuid
+
+import backends
+import worker
+
+
+# the protocol is newline-delimited json over a plain tcp connection
+# request : {"op": "claim", "worker_id": "...", "limit": 4}
+# response: {"ok": true, "jobs": [...]} or {"ok": false, "error": "..."}
+
+DEFAULT_PORT = 8765
+DEFAULT_LEASE = 30
+
+# jobs are shell commands, so anyone who can reach the port can run code on the
+# workers: a broker bound beyond loopback needs a shared token, sent with every request
+TOKEN_ENV = 'QUEUECTL_BROKER_TOKEN'
+
+
+# function to parse "host:port" (port defaults to DEFAULT_PORT)
+def parse_address(value: str):
+    host, _, port = (value or '').strip().rpartition(':')
+    if not host:
+        return (port or '127.0.0.1'), DEFAULT_PORT
+    return host, int(port)
+
+
+# function to check whether a bind address only accepts local connections
+def is_loopback(host: str) -> bool:
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+# broker operations, each takes the storage backend and the decoded request
+# and returns the response fields
+
+# a single job ("command", "max_retries", "external_id") or a batch ("jobs": [...])
+def op_enqueue(backend, req):
+    on_conflict = req.get('on_conflict') or 'return'
+    specs = req.get('jobs') or [{'command': req.get('command'), 'max_retries': req.get('max_retries'), 'external_id': req.get('external_id')}]
+    default_retries = None
+    jobs = []
+    for spec in specs:
+        if not spec.get('command'):
+            raise ValueError('command is required')
+        retries = spec.get('max_retries', spec.get('max_retires'))
+        if retries is None:
+            if default_retries is None:
+                default_retries = int(backend.get_config('max_retries', '3') or 3)
+            retries = default_retries
+        jobs.append({
+            'command': spec['command'], 'max_retires': int(retries),
+            'external_id': spec.get('external_id'), 'depends_on': worker.func_parse_depends_on(spec.get('depends_on')),
+            'cache_ttl': worker.func_parse_cache_ttl(spec.get('cache_ttl')),
+            'limits': worker.func_parse_limits(spec.get('limits') or spec),
+        })
+    results = backend.add_jobs(jobs, on_conflict)
+    events = []
+    for job_id, created in results:
+        if created:
+            events.append((job_id, 'enqueued'))
+        elif on_conflict == 'update':
+            events.append((job_id, 'updated'))
+    try:
+        backend.add_events(events)
+    except Exception:
+        pass
+    return {'id': results[0][0], 'created': results[0][1], 'results': results}
+
+
+def op_claim(backend, req, lease_seconds):
+    worker_id = str(req['worker_id'])
+    jobs = backend.claim_jobs(
+        worker_id, int(req.get('limit') or 1), int(req.get('lease') or lease_seconds), backend.shard_for_key(worker_id),
+    )
+    if jobs:
+        try:
+            worker_num = backend.worker_number(worker_id)
+            backend.add_events([(job['id'], 'processing', worker_num, int(job['attempts'] or 0) + 1) for job in jobs])
+        except Exception:
+            pass
+    return {'jobs': jobs}
+
+
+# complete, fail and release only act on jobs still leased to the calling worker
+def _lease_lost(job_id, worker_id):
+    return ValueError(f'job {job_id} is not leased to {worker_id}')
+
+
+def op_complete(backend, req):
+    job_id = int(req['id'])
+    worker_id = str(req['worker_id'])
+    if not backend.mark_complete(job_id, worker_id):
+        raise _lease_lost(job_id, worker_id)
+    try:
+        backend.add_event(job_id, 'cache_hit' if req.get('cache_hit') else 'completed', exit_code=req.get('exit_code'))
+    except Exception:
+        pass
+    return {}
+
+
+# the worker decides between retry and dead (same rules as the local loop)
+def op_fail(backend, req):
+    job_id = int(req['id'])
+    worker_id = str(req['worker_id'])
+    if req.get('dead'):
+        if not backend.mark_dead(job_id, worker_id):
+            raise _lease_lost(job_id, worker_id)
+        try:
+            backend.add_event(job_id, 'dead', attempt=req.get('attempts'), exit_code=req.get('exit_code'))
+        except Exception:
+            pass
+        return {}
+    attempts = int(req['attempts'])
+    if not backend.requeue_with_attempt(job_id, attempts, worker_id):
+        raise _lease_lost(job_id, worker_id)
+    try:
+        backend.add_event(job_id, 'retry_scheduled', attempt=attempts, delay=req.get('delay'), exit_code=req.get('exit_code'))
+    except Exception:
+        pass
+    return {}
+
+
+# unstarted jobs from a claimed batch go back to pending right away
+def op_release(backend, req):
+    return {'released': backend.release_jobs([int(i) for i in req.get('ids') or []], str(req['worker_id']))}
+
+
+# heartbeat registers the worker, extends the leases of the jobs it reports
+# holding and hands back the shared config
+def op_heartbeat(backend, req, lease_seconds):
+    worker_id = str(req['worker_id'])
+    status = req.get('status') or 'running'
+    if req.get('register'):
+        backend.register_worker(worker_id, int(req.get('pid') or 0))
+    backend.timestamp_worker(worker_id, status)
+    if status == 'running':
+        backend.extend_leases(worker_id, [int(i) for i in req.get('ids') or []], int(req.get('lease') or lease_seconds))
+    backoff = backend.get_config('backoff', None)
+    return {
+        'stop': backend.get_config('workers_should_stop', '0') == '1',
+        'backoff': int(backoff) if backoff is not None else None,
+    }
+
+
+def op_cache_get(backend, req):
+    hit = backend.cache_get(str(req['key']))
+    return {'hit': list(hit) if hit else None}
+
+
+def op_cache_put(backend, req):
+    backend.cache_put(str(req['key']), int(req['exit_code']), req.get('output'), int(req['ttl']))
+    return {}
+
+
+# cheap numbers for remote autoscalers
+def op_stats(backend, req):
+    return {
+        'pending': backend.count_pending(),
+        'stop': backend.get_config('workers_should_stop', '0') == '1',
+    }
+
+
+def op_set_config(backend, req):
+    backend.set_config(str(req['key']), str(req['value']))
+    return {}
+
+
+class _BrokerHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                req = json.loads(line)
+                resp = self.server.dispatch(req)
+                resp['ok'] = True
+            except Exception as e:
+                resp = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+            self.wfile.write((json.dumps(resp) + '\n').encode())
+            self.wfile.flush()
+
+
+class BrokerServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, lease_seconds: int = DEFAULT_LEASE, backend=None, token: str | None = None):
+        self.token = token or os.environ.get(TOKEN_ENV) or None
+        if not self.token and not is_loopback(address[0]):
+            raise ValueError(f"refusing to bind {address[0] or '*'} without a token (--token or {TOKEN_ENV})")
+        self.backend = backend or backends.get_backend()
+        self.backend.make_db()
+        self.lease_seconds = lease_seconds
+        super().__init__(address, _BrokerHandler)
+
+    def dispatch(self, req):
+        if self.token and not hmac.compare_digest(str(req.get('token') or ''), self.token):
+            raise PermissionError('missing or wrong broker token')
+        op = req.get('op')
+        if op == 'enqueue':
+            return op_enqueue(self.backend, req)
+        if op == 'claim':
+            return op_claim(self.backend, req, self.lease_seconds)
+        if op == 'complete':
+            return op_complete(self.backend, req)
+        if op == 'fail':
+            return op_fail(self.backend, req)
+        if op == 'release':
+            return op_release(self.backend, req)
+        if op == 'heartbeat':
+            return op_heartbeat(self.backend, req, self.lease_seconds)
+        if op == 'set_config':
+            return op_set_config(self.backend, req)
+        if op == 'stats':
+            return op_stats(self.backend, req)
+        if op == 'cache_get':
+            return op_cache_get(self.backend, req)
+        if op == 'cache_put':
+            return op_cache_put(self.backend, req)
+        raise ValueError(f'unknown op {op!r}')
+
+
+# function for starting the broker in a background thread (port 0 picks a free port)
+def func_start_background_broker(host: str = '127.0.0.1', port: int = 0, lease_seconds: int = DEFAULT_LEASE, backend=None,
+                                 token: str | None = None):
+    server = BrokerServer((host, port), lease_seconds, backend, token)
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    return server, t, server.server_address
+
+
+class BrokerError(Exception):
+    pass
+
+
+# client side of the protocol, one connection per client, safe to share between threads
+class BrokerClient:
+
+    def __init__(self, host: str, port: int, timeout: float = 30.0, token: str | None = None):
+        self.address = (host, port)
+        self.timeout = timeout
+        self.token = token or os.environ.get(TOKEN_ENV) or None
+        self._sock = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self._sock = socket.create_connection(self.address, timeout=self.timeout)
+        self._file = self._sock.makefile('rwb')
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        for f in (self._file, self._sock):
+            try:
+                if f is not None:
+                    f.close()
+            except Exception:
+                pass
+        self._sock = None
+        self._file = None
+
+    def request(self, op: str, **fields):
+        fields['op'] = op
+        if self.token:
+            fields['token'] = self.token
+        data = (json.dumps(fields) + '\n').encode()
+        with self._lock:
+            # an idle connection the broker closed (say it restarted) reads as ready
+            if self._sock is not None and select.select([self._sock], [], [], 0)[0]:
+                self._close()
+            # a request is only sent again when sending it failed on an old connection;
+            # once it went out the broker may have handled it, so a lost reply is an error
+            for attempt in (0, 1):
+                reused = self._sock is not None
+                try:
+                    if not reused:
+                        self._connect()
+                    self._file.write(data)
+                    self._file.flush()
+                    break
+                except OSError:
+                    self._close()
+                    if attempt or not reused:
+                        raise
+            try:
+                line = self._file.readline()
+            except OSError:
+                self._close()
+                raise
+            if not line:
+                self._close()
+                raise ConnectionError('broker closed the connection')
+        resp = json.loads(line)
+        if not resp.get('ok'):
+            raise BrokerError(resp.get('error') or 'broker error')
+        return resp
+
+    def enqueue(self, command: str, max_retries: int | None = None, external_id: str | None = None, on_conflict: str = 'return'):
+        return self.request('enqueue', command=command, max_retries=max_retries, external_id=external_id, on_conflict=on_conflict)['id']
+
+    # jobs: dicts with command and optional max_retires, external_id; returns [(job_id, created)]
+    def enqueue_many(self, jobs, on_conflict: str = 'return'):
+        return [tuple(r) for r in self.request('enqueue', jobs=jobs, on_conflict=on_conflict)['results']]
+
+    def claim(self, worker_id: str, limit: int = 1, lease: int | None = None):
+        return self.request('claim', worker_id=worker_id, limit=limit, lease=lease)['jobs']
+
+    # complete and fail raise BrokerError when the job is no longer leased to worker_id
+    def complete(self, worker_id: str, job_id: int, cache_hit: bool = False, exit_code: int | None = None):
+        self.request('complete', worker_id=worker_id, id=job_id, cache_hit=cache_hit, exit_code=exit_code)
+
+    def fail(self, worker_id: str, job_id: int, attempts: int, dead: bool = False, delay: int | None = None,
+             exit_code: int | None = None):
+        self.request('fail', worker_id=worker_id, id=job_id, attempts=attempts, dead=dead, delay=delay, exit_code=exit_code)
+
+    def release(self, worker_id: str, job_ids):
+        return self.request('release', worker_id=worker_id, ids=list(job_ids))['released']
+
+    # job_ids: the claimed jobs the worker still holds, only their leases are extended
+    def heartbeat(self, worker_id: str, status: str = 'running', register: bool = False, lease: int | None = None,
+                  job_ids=()):
+        return self.request('heartbeat', worker_id=worker_id, status=status, register=register, pid=os.getpid(), lease=lease,
+                            ids=list(job_ids))
+
+    def set_config(self, key: str, value: str):
+        self.request('set_config', key=key, value=value)
+
+    def stats(self):
+        return self.request('stats')
+
+    def cache_get(self, key: str):
+        return self.request('cache_get', key=key)['hit']
+
+    def cache_put(self, key: str, exit_code: int, output: str | None, ttl: int):
+        self.request('cache_put', key=key, exit_code=exit_code, output=output, ttl=ttl)
+
+
+# function for the broker worker loop: same job rules as worker.worker_loop
+# but jobs are claimed in batches from the broker instead of from sqlite
+def broker_worker_loop(address, poll_interval: float = 1.0, backoff_base: int = 2, worker_id: str | None = None,
+                       batch_size: int = 4, lease_seconds: int = DEFAULT_LEASE,
+                       stop_event: threading.Event | None = None, stats=None, limits: dict | None = None, pinner=None):
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    client = BrokerClient(*address)
+    state = client.heartbeat(worker_id, register=True, lease=lease_seconds)
+
+    # keep the leases of claimed jobs alive while long commands run; only the jobs
+    # this loop actually received are renewed
+    done = threading.Event()
+    held = set()
+    held_lock = threading.Lock()
+
+    def holding():
+        with held_lock:
+            return sorted(held)
+
+    def drop(*job_ids):
+        with held_lock:
+            held.difference_update(job_ids)
+
+    def keep_alive():
+        while not done.wait(max(1.0, lease_seconds / 3)):
+            try:
+                client.heartbeat(worker_id, lease=lease_seconds, job_ids=holding())
+            except Exception:
+                pass
+
+    threading.Thread(target=keep_alive, daemon=True).start()
+
+    # a job whose lease ran out may belong to another worker by now; its result is dropped
+    def finish(call, job_id, *args, **kwargs):
+        try:
+            call(worker_id, job_id, *args, **kwargs)
+            return True
+        except BrokerError as e:
+            print(f"worker {worker_id} lost job {job_id}: {e}")
+            return False
+        finally:
+            drop(job_id)
+
+    try:
+        while True:
+            if stop_event is not None and stop_event.is_set():
+                client.heartbeat(worker_id, 'stopped')
+                break
+            jobs = client.claim(worker_id, batch_size, lease_seconds)
+            with held_lock:
+                held.update(j['id'] for j in jobs)
+            if not jobs:
+                if state.get('stop'):
+                    client.heartbeat(worker_id, 'stopped')
+                    break
+                time.sleep(poll_interval)
+                state = client.heartbeat(worker_id, lease=lease_seconds)
+                continue
+
+            # the whole batch is leased to this worker, so it is drained even after a stop signal
+            for index, job in enumerate(jobs):
+                job_id = job['id']
+                attempts = int(job['attempts'] or 0)
+                max_retires = int(job['max_retires'] or 3)
+                print(f"worker {worker_id} processing job {job_id} (attempt {attempts + 1}/{max_retires})")
+                if stats:
+                    stats.job_started(worker_id)
+                cache_key = None
+                if job.get('cache_ttl'):
+                    cache_key = worker.func_cache_key(job['command'], worker.func_merge_limits(job.get('limits'), limits))
+                cached = client.cache_get(cache_key) if cache_key else None
+                if cached:
+                    if stats:
+                        stats.job_finished(worker_id)
+                    if finish(client.complete, job_id, cache_hit=True, exit_code=cached[0]):
+                        print(f"worker {worker_id} completed job {job_id} from cache")
+                    continue
+                exit_code, output = worker.func_run_job(job['command'], job.get('limits'), limits, pinner)
+                ok = exit_code == 0
+                if ok and cache_key:
+                    client.cache_put(cache_key, exit_code, output, int(job['cache_ttl']))
+                if stats:
+                    stats.job_finished(worker_id)
+                if ok:
+                    if finish(client.complete, job_id, exit_code=exit_code):
+                        print(f"worker {worker_id} completed job {job_id}")
+                    continue
+
+                next_attempts = attempts + 1
+                if next_attempts >= max_retires:
+                    if finish(client.fail, job_id, next_attempts, dead=True, exit_code=exit_code):
+                        print(f"worker {worker_id} moved job {job_id} to DLQ")
+                    continue
+
+                base = state.get('backoff') if state.get('backoff') is not None else backoff_base
+                delay = base ** next_attempts
+                print(f"worker {worker_id} retrying job {job_id} in {delay}s (attempt {next_attempts}/{max_retires})")
+                # hand the rest of the batch back so other workers are not stuck behind this backoff
+                rest = [j['id'] for j in jobs[index + 1:]]
+                if rest:
+                    client.release(worker_id, rest)
+                    drop(*rest)
+                time.sleep(delay)
+                finish(client.fail, job_id, next_attempts, delay=delay, exit_code=exit_code)
+                break
+            state = client.heartbeat(worker_id, lease=lease_seconds, job_ids=holding())
+    finally:
+        done.set()
+        client.close()
+
+
+# function for starting a broker worker in a background thread
+def func_start_background_broker_worker(address, poll_interval: float = 1.0, backoff_base: int = 2,
+                                        batch_size: int = 4, lease_seconds: int = DEFAULT_LEASE,
+                                        stop_event: threading.Event | None = None, stats=None,
+                                        limits: dict | None = None, pinner=None):
+    wid = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    t = threading.Thread(target=broker_worker_loop, args=(address,), kwargs={
+        'poll_interval': poll_interval,
+        'backoff_base': backoff_base,
+        'worker_id': wid,
+        'batch_size': batch_size,
+        'lease_seconds': lease_seconds,
+        'stop_event': stop_event,
+        'stats': stats,
+        'limits': limits,
+        'pinner': pinner,
+    }, daemon=True)
+    t.start()
+    return t, wid
@@ -4,54 +4,126 @@ import sys
 import time
 import storage
 import worker
+import broker
+import backends
 
-# function for enqueuing a command to the queue
-def cmd_enqueue(args):
-    storage.make_db()
-    command = None 
+# function to turn the enqueue payload into job specs
+# the payload is a json object, a json array of objects (bulk enqueue) or a plain command
+def parse_enqueue_payload(args, default_retries):
+    payload_str = args.payload if isinstance(args.payload, str) else ' '.join(args.payload or [])
     try:
+        load_json = json.loads(payload_str)
+    except Exception:
         load_json = None
-        try:
-        # parsing the command from the user in json format
+    if isinstance(load_json, dict):
+        items = [load_json]
+    elif isinstance(load_json, list) and load_json and all(isinstance(i, dict) for i in load_json):
+        items = load_json
+    else:
+        # if the command is not in json format, then we are setting the command and retries from the command line arguments
+        return [{'command': payload_str, 'max_retires': default_retries, 'external_id': None}]
+    jobs = []
+    for item in items:
+        retries = item.get('max_retries')
+        jobs.append({
+            'command': item.get('command'),
+            'max_retires': int(retries) if retries else default_retries,
+            'external_id': item.get('id'),
+            'depends_on': worker.func_parse_depends_on(item.get('depends_on')),
+            'cache_ttl': worker.func_parse_cache_ttl(item.get('cache_ttl')),
+            'limits': worker.func_parse_limits(item),
+        })
+    return jobs
+
+
+# function to turn a sqlite timestamp into ISO 8601 with a Z suffix
+def to_iso_z(ts: str | None) -> str:
+    if not ts:
+        return ""
+    s = str(ts)
+    if 'T' not in s and ' ' in s:
+        s = s.replace(' ', 'T')
+    if not s.endswith('Z'):
+        s = s + 'Z'
+    return s
+
+
+# function to create or migrate the database and report what a migration changed
+def prepare_db(make_db=storage.make_db):
+    cleared = make_db()
+    if cleared:
+        print(f"note: cleared duplicate external_id on {cleared} newer job(s)", file=sys.stderr)
+
+
+# function to get the storage backend for a cli command. a process-local backend
+# would start empty in every cli process, so only `serve` may run one
+def cli_backend():
+    try:
+        backend = backends.get_backend()
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    if backend.name != 'sqlite':
+        print(f"backend '{backend.name}' is process-local; run 'serve --backend {backend.name}' and use --broker", file=sys.stderr)
+        sys.exit(1)
+    prepare_db(backend.make_db)
+    return backend
 
-            payload_str = args.payload if isinstance(args.payload, str) else ' '.join(args.payload or [])
-            load_json = json.loads(payload_str)
-        except Exception:
-            load_json = None
-        
-        # getting command from the json and setting the default retries and saving in the database
-        if load_json:
-            command = load_json.get('command')
-            default_retries = int(storage.get_config('max_retries', str(args.retries)) or args.retries)
-            retries = int(load_json.get('max_retries') or default_retries)
-            external_id = load_json.get('id')
+
+# function for enqueuing a command to the queue
+def cmd_enqueue(args):
+    # with --broker the jobs are handed to the broker, which owns the database,
+    # applies its own max_retries default and records the events
+    try:
+        if args.broker:
+            jobs = parse_enqueue_payload(args, None)
         else:
-            # if the command is not in json format, then we are setting the command and retries from the command line arguments
-            payload_str = args.payload if isinstance(args.payload, str) else ' '.join(args.payload or [])
-            command = payload_str
-            retries = int(storage.get_config('max_retries', str(args.retries)) or args.retries)
-            external_id = None
-    except Exception:
-        payload_str = args.payload if isinstance(args.payload, str) else ' '.join(args.payload or [])
-        command = payload_str
-        retries = int(storage.get_config('max_retries', str(args.retries)) or args.retries)
-        external_id = None
-    job_id = storage.add_job(command, state='pending', max_retires=retries, external_id=external_id)
-    if job_id is not None:
-        print(f"enqueued {job_id}")
+            backend = cli_backend()
+            jobs = parse_enqueue_payload(args, int(backend.get_config('max_retries', str(args.retries)) or args.retries))
+    except ValueError as e:
+        print(f"invalid job: {e}", file=sys.stderr)
+        sys.exit(1)
+    if not all(job['command'] for job in jobs):
+        print('command is required', file=sys.stderr)
+        sys.exit(1)
+
+    if args.broker:
+        host, port = broker.parse_address(args.broker)
+        try:
+            results = broker.BrokerClient(host, port).enqueue_many(jobs, args.on_duplicate)
+        except Exception as e:
+            print(f"broker error: {e}", file=sys.stderr)
+            sys.exit(1)
+    else:
+        try:
+            results = backend.add_jobs(jobs, args.on_duplicate)
+        except Exception as e:
+            print(f"Error adding job: {e}", file=sys.stderr)
+            sys.exit(1)
+        events = []
+        for job_id, created in results:
+            if created:
+                events.append((job_id, 'enqueued'))
+            elif args.on_duplicate == 'update':
+                events.append((job_id, 'updated'))
         try:
-            storage.add_event(job_id, 'enqueued', f'cmd={command}, max_retires={retries}')
+            backend.add_events(events)
         except Exception:
             pass
-    else:
-        sys.exit(1)
+
+    # a repeated id is not an error: producers retrying a timed out enqueue get the same job back
+    for job_id, created in results:
+        if created:
+            print(f"enqueued {job_id}")
+        else:
+            print(f"enqueued {job_id} ({'updated' if args.on_duplicate == 'update' else 'existing'})")
 
 
 # function for listing jobs from the queue
 def cmd_list(args):
-    storage.make_db()
+    backend = cli_backend()
     # getting the jobs from the database based on the state
-    rows = storage.list_jobs(args.state)
+    rows = backend.list_jobs(args.state)
     job_values = f"Jobs ({args.state if args.state else 'all'}):"
     print(job_values)
     if not rows:
@@ -65,74 +137,99 @@ def cmd_list(args):
 
 # function for handling the dead letter queue
 def cmd_dlq(args):
-    storage.make_db()
-    # listing the jobs in the dead letter queue
-    if args.action == 'list':
-        rows = storage.list_dead_jobs_with_external()
-        # if no rows found print dlq is empty else print the jobs in dead letter queue
-        if not rows:
-            print('DLQ is empty')
-        else:
-            for r in rows:
-                # r: id, external_id, command
+    backend = cli_backend()
+    try:
+        # listing the jobs in the dead letter queue, streamed newest first
+        if args.action == 'list':
+            empty = True
+            for r in backend.iter_dead_jobs(args.since, args.match):
+                empty = False
+                # r: id, external_id, command, ...
                 ext = r[1] or '-'
                 print(f"{r[0]} ({ext})\tdead\tcmd={r[2]}")
-    # if the action is retry then retry the job in the dead letter queue
-    elif args.action == 'retry':
-        # support numeric id or external id, e.g., 'job1'
-        res = storage.retry_dead_by_identifier(str(args.job_id))
-        if res:
-            print(f"retried {args.job_id}")
+            # if no rows found print dlq is empty
+            if empty:
+                print('DLQ is empty')
+        elif args.job_id:
+            if args.action != 'retry':
+                print(f"dlq {args.action} takes --all, --since or --match, not a job id", file=sys.stderr)
+                sys.exit(1)
+            retry_one(backend, args)
+        # the bulk forms need --all or a filter so a typo can't empty the whole dlq
+        elif args.action != 'export' and not (args.all or args.since or args.match):
+            print(f"dlq {args.action} needs a job id, --all, --since or --match", file=sys.stderr)
+            sys.exit(1)
+        # --dry-run: only count what the operation would touch
+        elif args.dry_run:
+            print(f"would {args.action} {backend.count_dead(args.since, args.match)} jobs")
+        # one JSON object per dead job, written as it is read
+        elif args.action == 'export':
+            for r in backend.iter_dead_jobs(args.since, args.match):
+                print(json.dumps({
+                    "id": str(r[0]), "external_id": r[1], "command": r[2], "state": "dead",
+                    "attempts": int(r[3] or 0), "max_retries": int(r[4] or 0),
+                    "created_at": to_iso_z(r[5]), "updated_at": to_iso_z(r[6]),
+                }))
+        elif args.action == 'purge':
+            print(f"purged {backend.purge_dead(args.since, args.match)} jobs")
+        else:
+            print(f"retried {backend.retry_dead_jobs(args.since, args.match)} jobs")
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+# function for retrying a single job in the dead letter queue
+def retry_one(backend, args):
+    if args.dry_run:
+        ident = str(args.job_id)
+        row = backend.get_job(int(ident)) if ident.isdigit() else backend.get_job_by_external_id(ident)
+        print(f"would retry {1 if row and row[2] == 'dead' else 0} jobs")
+        return
+    # support numeric id or external id, e.g., 'job1'
+    res = backend.retry_dead_by_identifier(str(args.job_id))
+    if res:
+        print(f"retried {args.job_id}")
+        try:
+            # if args.job_id isn't numeric, look up id for event
             try:
-                # if args.job_id isn't numeric, look up id for event
-                try:
-                    jid = int(args.job_id)
-                except Exception:
-                    row = storage.get_job_by_external_id(str(args.job_id))
-                    jid = int(row[0]) if row else None
-                if jid is not None:
-                    storage.add_event(jid, 'dlq_retry', None)
+                jid = int(args.job_id)
             except Exception:
-                pass
-        else:
-            print(f"job {args.job_id} not in DLQ", file=sys.stderr)
-            sys.exit(1)
+                row = backend.get_job_by_external_id(str(args.job_id))
+                jid = int(row[0]) if row else None
+            if jid is not None:
+                backend.add_event(jid, 'dlq_retry')
+        except Exception:
+            pass
+    else:
+        print(f"job {args.job_id} not in DLQ", file=sys.stderr)
+        sys.exit(1)
 
 
 # function for showing job and worker status
 def cmd_status(args):
-    storage.make_db()
+    backend = cli_backend()
     try:
-        counts = storage.counts_by_state() or {}
+        counts = backend.counts_by_state() or {}
     except Exception:
-        storage.make_db()
-        counts = storage.counts_by_state() or {}
-    full = {'pending': 0, 'processing': 0, 'completed': 0, 'failed': 0, 'dead': 0}
+        backend.make_db()
+        counts = backend.counts_by_state() or {}
+    full = {'pending': 0, 'blocked': 0, 'processing': 0, 'completed': 0, 'failed': 0, 'dead': 0}
     full.update(counts)
     print("Jobs:")
-    for s in ['pending', 'processing', 'completed', 'failed', 'dead']:
+    for s in ['pending', 'blocked', 'processing', 'completed', 'failed', 'dead']:
         print(f"  {s}: {full.get(s,0)}")
     try:
-        active = storage.count_active_workers(10)
+        active = backend.count_active_workers(10)
     except Exception:
-        storage.make_db()
-        active = storage.count_active_workers(10)
+        backend.make_db()
+        active = backend.count_active_workers(10)
     print(f"Active workers: {active}")
 
 
 def cmd_history(args):
-    storage.make_db()
+    backend = cli_backend()
     # Output jobs in JSON schema: id, command, state, attempts, max_retries, created_at, updated_at
-    def to_iso_z(ts: str | None) -> str:
-        if not ts:
-            return ""
-        s = str(ts)
-        if 'T' not in s and ' ' in s:
-            s = s.replace(' ', 'T')
-        if not s.endswith('Z'):
-            s = s + 'Z'
-        return s
-
     def print_job_row(row):
         job = {
             "id": str(row[0]),
@@ -146,32 +243,84 @@ def cmd_history(args):
         import json as _json
         print(_json.dumps(job))
 
+    # --events: the event timeline (of one job with --job-id), one JSON object per line
+    if args.events:
+        try:
+            rows = backend.list_events(args.job_id, None if args.all else args.limit, args.since, args.until, args.order)
+        except ValueError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        if not rows:
+            print("<none>")
+            return
+        import json as _json
+        for row in rows:
+            event = {"id": row[0], "job_id": str(row[1]), "event": row[2]}
+            # only the details the event has
+            for name, value in zip(storage.EVENT_FIELDS, row[3:8]):
+                if value is not None:
+                    event[name] = value
+            event["created_at"] = to_iso_z(row[8])
+            print(_json.dumps(event))
+        return
+
     if args.job_id is not None:
-        row = storage.get_job(int(args.job_id))
+        row = backend.get_job(int(args.job_id))
         if not row:
             print("<none>")
             return
         print_job_row(row)
         return
 
-    rows = storage.list_jobs(None)
+    rows = backend.list_jobs(None)
     if not rows:
         print("<none>")
         return
     for row in rows:
         print_job_row(row)
 
+# function for the limits given to `worker start` (--cpu-affinity, --nice, --memory-mb,
+# --cpu-seconds) and, with --pin, the pinner that spreads the pool's jobs over the cpus
+def worker_limits(args):
+    try:
+        limits = worker.func_parse_limits({
+            'cpu_affinity': args.cpu_affinity, 'nice': args.nice,
+            'memory_mb': args.memory_mb, 'cpu_seconds': args.cpu_seconds,
+        })
+    except ValueError as e:
+        print(f"invalid limit: {e}", file=sys.stderr)
+        sys.exit(1)
+    pinner = worker.CorePinner((limits or {}).get('cpu_affinity')) if args.pin else None
+    return limits, pinner
+
+
 # function for starting and stopping workers
 def cmd_worker(args):
-    storage.make_db()
+    if args.broker:
+        return cmd_worker_broker(args)
+    backend = cli_backend()
     # if the action is start then start the workers by setting the workers_should_stop config to 0 because 0 means workers should not stop
     if args.action == 'start':
-        storage.set_config('workers_should_stop', '0')
+        backend.set_config('workers_should_stop', '0')
+        limits, pinner = worker_limits(args)
+        if args.min is not None or args.max is not None:
+            return run_autoscaler(
+                args,
+                lambda stop_event, stats: worker.func_start_background_worker(
+                    poll_interval=1.0, backoff_base=args.backoff, backend=backend, stop_event=stop_event, stats=stats,
+                    limits=limits, pinner=pinner,
+                ),
+                backend.count_pending,
+                lambda: backend.get_config('workers_should_stop', '0') == '1',
+                lambda: backend.set_config('workers_should_stop', '1'),
+            )
         threads = []
         worker_ids = []
         # starting the workers in the background by creating each worker a new thread
         for _ in range(args.count):
-            t, wid = worker.func_start_background_worker(poll_interval=1.0, backoff_base=args.backoff)
+            t, wid = worker.func_start_background_worker(
+                poll_interval=1.0, backoff_base=args.backoff, backend=backend, limits=limits, pinner=pinner,
+            )
             threads.append(t)
             worker_ids.append(wid)
         print(f"started {len(worker_ids)} worker(s): {', '.join(worker_ids)}")
@@ -181,19 +330,176 @@ def cmd_worker(args):
                 time.sleep(1)
         except KeyboardInterrupt:
             print('stopping workers...')
-            storage.set_config('workers_should_stop', '1')
+            backend.set_config('workers_should_stop', '1')
     # if the action is stop then stop the workers by setting the workers_should_stop config to 1 because 1 means workers should stop
     elif args.action == 'stop':
-        storage.set_config('workers_should_stop', '1')
+        backend.set_config('workers_should_stop', '1')
         print('signaled workers to stop')
     else:
         print('unknown action', file=sys.stderr)
         sys.exit(1)
 
 
+# function for running an autoscaled worker pool in the foreground (worker start --min/--max)
+def run_autoscaler(args, start_worker, sample_pending, should_stop, signal_stop):
+    lo = args.min if args.min is not None else 1
+    hi = args.max if args.max is not None else max(lo, args.count)
+    try:
+        scaler = worker.Autoscaler(start_worker, sample_pending, min_workers=lo, max_workers=hi, interval=args.scale_interval)
+    except ValueError as e:
+        print(f"invalid pool size: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(f"autoscaling between {lo} and {hi} worker(s)")
+    try:
+        scaler.run(should_stop)
+    except KeyboardInterrupt:
+        print('stopping workers...')
+        signal_stop()
+
+
+# function for starting and stopping workers that talk to a broker instead of sqlite
+def cmd_worker_broker(args):
+    host, port = broker.parse_address(args.broker)
+    client = broker.BrokerClient(host, port)
+    try:
+        if args.action == 'start':
+            client.set_config('workers_should_stop', '0')
+            limits, pinner = worker_limits(args)
+            if args.min is not None or args.max is not None:
+                return run_autoscaler(
+                    args,
+                    lambda stop_event, stats: broker.func_start_background_broker_worker(
+                        (host, port), poll_interval=1.0, backoff_base=args.backoff, batch_size=args.batch,
+                        lease_seconds=args.lease, stop_event=stop_event, stats=stats, limits=limits, pinner=pinner,
+                    ),
+                    lambda: client.stats()['pending'],
+                    lambda: client.stats()['stop'],
+                    lambda: client.set_config('workers_should_stop', '1'),
+                )
+            worker_ids = []
+            for _ in range(args.count):
+                t, wid = broker.func_start_background_broker_worker(
+                    (host, port), poll_interval=1.0, backoff_base=args.backoff,
+                    batch_size=args.batch, lease_seconds=args.lease, limits=limits, pinner=pinner,
+                )
+                worker_ids.append(wid)
+            print(f"started {len(worker_ids)} worker(s) on broker {host}:{port}: {', '.join(worker_ids)}")
+            try:
+                while True:
+                    time.sleep(1)
+            except KeyboardInterrupt:
+                print('stopping workers...')
+                client.set_config('workers_should_stop', '1')
+        elif args.action == 'stop':
+            client.set_config('workers_should_stop', '1')
+            print('signaled workers to stop')
+    except OSError as e:
+        print(f"broker error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+# function for running the network broker in the foreground
+def cmd_serve(args):
+    try:
+        backend = backends.get_backend(args.backend)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    try:
+        server = broker.BrokerServer((args.host, args.port), lease_seconds=args.lease, backend=backend, token=args.token)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    host, port = server.server_address[:2]
+    where = f"db={storage.dp_path}" if backend.name == 'sqlite' else 'not persisted'
+    print(f"broker listening on {host}:{port} (backend={backend.name}, {where})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('stopping broker...')
+    finally:
+        server.server_close()
+
+
+# function for inspecting and clearing the result cache
+def cmd_cache(args):
+    backend = cli_backend()
+    if args.action == 'stats':
+        for key, value in backend.cache_stats().items():
+            print(f"{key}: {value}")
+    elif args.action == 'clear':
+        print(f"cleared {backend.cache_clear()} cache entries")
+
+
+# function for an online backup of every shard while workers keep running
+def cmd_backup(args):
+    prepare_db()
+    try:
+        files = storage.backup(args.path)
+    except (ValueError, OSError, storage.sqlite3.Error) as e:
+        print(f"backup failed: {e}", file=sys.stderr)
+        sys.exit(1)
+    for path in files:
+        print(f"backed up to {path}")
+
+
+# function for streaming jobs with their dependents and events as JSON lines
+def cmd_export(args):
+    prepare_db()
+    try:
+        out = open(args.output, 'w') if args.output and args.output != '-' else sys.stdout
+    except OSError as e:
+        print(f"export failed: {e}", file=sys.stderr)
+        sys.exit(1)
+    count = 0
+    try:
+        for record in storage.iter_export():
+            out.write(json.dumps(record) + '\n')
+            count += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    if out is not sys.stdout:
+        print(f"exported {count} jobs to {args.output}")
+
+
+# function for loading an export; the file (or stdin) is read line by line
+def cmd_import(args):
+    prepare_db()
+    try:
+        src = open(args.path) if args.path and args.path != '-' else sys.stdin
+    except OSError as e:
+        print(f"import failed: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    def records():
+        for n, line in enumerate(src, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                raise ValueError(f"line {n} is not valid JSON")
+
+    try:
+        imported, skipped, conflicts = storage.import_jobs(records())
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"import failed: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if src is not sys.stdin:
+            src.close()
+    print(f"imported {imported} jobs ({skipped} already present, {len(conflicts)} conflicts)")
+    # a conflicting job is one whose id or external id is held by a different job here
+    if conflicts:
+        shown = ', '.join(str(i) for i in conflicts[:20]) + (' ...' if len(conflicts) > 20 else '')
+        print(f"conflicts (id or external id taken by a different job, not imported): {shown}", file=sys.stderr)
+        sys.exit(1)
+
+
 # function in which users can set and get the config values
 def cmd_config(args):
-    storage.make_db()
+    prepare_db()
     # normalize common key variants (e.g., max-retries -> max_retries)
     key = (args.key or '').replace('-', '_')
     # if user want to make 'set config' then set the config value in the database
@@ -201,7 +507,21 @@ def cmd_config(args):
         if args.value is None:
             print('value is required for config set', file=sys.stderr)
             sys.exit(1)
-        storage.set_config(key, args.value)
+        if key == 'backend' and args.value not in backends.BACKENDS:
+            print(f"unknown backend {args.value!r} (expected one of: {', '.join(backends.BACKENDS)})", file=sys.stderr)
+            sys.exit(1)
+        if key == 'dependency_failure' and args.value not in storage.DEPENDENCY_FAILURE_RULES:
+            print(f"dependency_failure must be one of: {', '.join(storage.DEPENDENCY_FAILURE_RULES)}", file=sys.stderr)
+            sys.exit(1)
+        # the shard count decides where every job lives, so it has its own guarded setter
+        if key == 'shards':
+            try:
+                storage.set_shard_count(int(args.value))
+            except ValueError as e:
+                print(f"cannot set shards: {e}", file=sys.stderr)
+                sys.exit(1)
+        else:
+            storage.set_config(key, args.value)
         print(f"{key}={args.value}")
     # if user want to make 'get config' then get the config value from the database
     elif args.cfg_action == 'get':
@@ -227,12 +547,16 @@ def build_parser():
     p_enq = sub.add_parser('enqueue', help='enqueue a command')
     p_enq.add_argument('payload', nargs=argparse.REMAINDER)
     p_enq.add_argument('--retries', type=int, default=3)
+    p_enq.add_argument('--broker', type=str, required=False, help='host:port of a queuectl broker')
+    # eg command : python queuectl.py enqueue --on-duplicate update '{"id":"job1","command":"echo v2"}'
+    p_enq.add_argument('--on-duplicate', choices=['return', 'update'], default='return',
+                       help="what an already used id does: return the existing job or update it")
     p_enq.set_defaults(func=cmd_enqueue)
 
     # building the parser for list command
     # eg command : python queuectl.py list --state pending
     p_list = sub.add_parser('list', help='list jobs')
-    p_list.add_argument('--state', choices=['pending','processing','completed','failed','dead'], required=False)
+    p_list.add_argument('--state', choices=['pending','blocked','processing','completed','failed','dead'], required=False)
     p_list.set_defaults(func=cmd_list)
 
     # status command
@@ -242,8 +566,13 @@ def build_parser():
     # building the parser for dead letter queue command
     # eg command : python queuectl.py dlq list
     p_dlq = sub.add_parser('dlq', help='dead letter queue ops')
-    p_dlq.add_argument('action', choices=['list','retry'])
+    p_dlq.add_argument('action', choices=['list','retry','purge','export'])
     p_dlq.add_argument('job_id', nargs='?')
+    # eg command : python queuectl.py dlq retry --since "2025-11-06 14:00:00" --match "curl *" --dry-run
+    p_dlq.add_argument('--all', action='store_true', help='retry/purge every dead job')
+    p_dlq.add_argument('--since', type=str, required=False, help='only jobs that went dead at or after this time')
+    p_dlq.add_argument('--match', type=str, required=False, help='only jobs whose command matches this glob')
+    p_dlq.add_argument('--dry-run', action='store_true', help='print how many jobs would be affected')
     p_dlq.set_defaults(func=cmd_dlq)
 
     # building the parser for worker command
@@ -252,8 +581,32 @@ def build_parser():
     p_worker.add_argument('action', choices=['start','stop'])
     p_worker.add_argument('--count', nargs='?', const=1, type=int, default=1)
     p_worker.add_argument('--backoff', type=int, default=2)
+    # eg command : python queuectl.py worker start --count 4 --broker 10.0.0.5:8765
+    p_worker.add_argument('--broker', type=str, required=False, help='host:port of a queuectl broker')
+    p_worker.add_argument('--batch', type=int, default=4, help='jobs claimed per broker round trip')
+    p_worker.add_argument('--lease', type=int, default=broker.DEFAULT_LEASE, help='lease length in seconds')
+    # eg command : python queuectl.py worker start --min 1 --max 8
+    p_worker.add_argument('--min', type=int, required=False, help='autoscale: fewest workers to keep')
+    p_worker.add_argument('--max', type=int, required=False, help='autoscale: most workers to run')
+    p_worker.add_argument('--scale-interval', type=float, default=2.0, help='autoscale: seconds between samples')
+    # eg command : python queuectl.py worker start --count 4 --pin --nice 5 --memory-mb 2048
+    p_worker.add_argument('--cpu-affinity', type=str, required=False, help='cpus job commands may use, e.g. 0-3,6')
+    p_worker.add_argument('--nice', type=int, required=False, help='niceness increment for job commands')
+    p_worker.add_argument('--memory-mb', type=int, required=False, help='address space limit per job command (RLIMIT_AS)')
+    p_worker.add_argument('--cpu-seconds', type=int, required=False, help='cpu time limit per job command (RLIMIT_CPU)')
+    p_worker.add_argument('--pin', action='store_true', help='pin each running job to its own cpu, spreading jobs over the cores')
     p_worker.set_defaults(func=cmd_worker)      
 
+    # building the parser for serve command
+    # eg command : python queuectl.py serve --port 8765
+    p_serve = sub.add_parser('serve', help='run the network broker')
+    p_serve.add_argument('--host', type=str, default='127.0.0.1')
+    p_serve.add_argument('--port', type=int, default=broker.DEFAULT_PORT)
+    p_serve.add_argument('--lease', type=int, default=broker.DEFAULT_LEASE, help='default lease length in seconds')
+    p_serve.add_argument('--token', type=str, required=False, help=f'shared secret clients must send (default: ${broker.TOKEN_ENV}); required off loopback')
+    p_serve.add_argument('--backend', choices=list(backends.BACKENDS), required=False, help="storage backend (default: 'backend' config key, else sqlite)")
+    p_serve.set_defaults(func=cmd_serve)
+
     # building the parser for config command
     # eg command : python queuectl.py config set max_retries 3
     # eg command : python queuectl.py config get max_retries
@@ -263,10 +616,31 @@ def build_parser():
     p_cfg.add_argument('value', nargs='?')
     p_cfg.set_defaults(func=cmd_config)
 
+    # building the parser for cache command
+    # eg command : python queuectl.py cache stats
+    p_cache = sub.add_parser('cache', help='result cache for jobs enqueued with cache_ttl')
+    p_cache.add_argument('action', choices=['stats', 'clear'])
+    p_cache.set_defaults(func=cmd_cache)
+
+    # building the parsers for backup, export and import
+    # eg command : python queuectl.py backup /backups/queuectl.db
+    p_backup = sub.add_parser('backup', help='online backup of the database (every shard)')
+    p_backup.add_argument('path')
+    p_backup.set_defaults(func=cmd_backup)
+    # eg command : python queuectl.py export --output queue.jsonl
+    p_export = sub.add_parser('export', help='write jobs and events as JSON lines')
+    p_export.add_argument('--output', type=str, required=False, help='file to write (default: stdout)')
+    p_export.set_defaults(func=cmd_export)
+    # eg command : python queuectl.py import queue.jsonl
+    p_import = sub.add_parser('import', help='load jobs and events written by export')
+    p_import.add_argument('path', nargs='?', default='-', help='file to read (default: stdin)')
+    p_import.set_defaults(func=cmd_import)
+
     # history command
     p_hist = sub.add_parser('history', help='show job/event history')
     p_hist.add_argument('--job-id', type=int, required=False)
-    # history now prints job records; keep args for forward compatibility but they are ignored
+    # history prints job records; with --events it prints the event timeline and the filters below apply
+    p_hist.add_argument('--events', action='store_true', help='show lifecycle events instead of job records')
     p_hist.add_argument('--limit', type=int, default=100)
     p_hist.add_argument('--all', action='store_true')
     p_hist.add_argument('--since', type=str, required=False)
@@ -1,15 +1,25 @@
+import calendar
+import heapq
+import json
+import os
+import random
 import sqlite3
+import tempfile
+import time
+import zlib
 
 dp_path='queuectl.db'
 
-# function to make a database
-# 3 db : jobs, config, workers
-def make_db():
-   
-    conn=sqlite3.connect(dp_path)
-    cur=conn.cursor()
-    # jobs : to store the jobs in the database
-    cur.execute('''
+# jobs and events can be spread over several database files ("shards") so that
+# writers on different shards do not wait for the same sqlite lock.
+# shard 0 is dp_path itself and also holds config and workers; shard i > 0 is
+# queuectl.<i>.db. a job with id n always lives in shard n % shard_count().
+_shards = None
+_shards_read_at = 0.0
+# long-running workers and brokers pick up 'config set shards' within this many seconds
+SHARDS_REFRESH = 5.0
+
+_JOBS_DDL = '''
         CREATE TABLE IF NOT EXISTS jobs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             command TEXT NOT NULL,
@@ -19,7 +29,40 @@ def make_db():
             created_at DateTime NOT NULL DEFAULT CURRENT_TIMESTAMP,
             updated_at DateTime NOT NULL DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
+    '''
+
+# events are compact: the event name is a small integer code (EVENT_TYPES), the
+# details are numeric columns (worker is workers.num of shard 0) and created_at is
+# unix seconds, so a row is a couple of dozen bytes instead of a free-text line
+_EVENTS_DDL = '''
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY,
+            job_id INTEGER,
+            type INTEGER NOT NULL,
+            worker INTEGER,
+            attempt INTEGER,
+            delay INTEGER,
+            exit_code INTEGER,
+            upstream INTEGER,
+            created_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+        )
+    '''
+
+# event codes are stored in the database, so new event types are only ever appended
+EVENT_TYPES = ('enqueued', 'updated', 'processing', 'completed', 'retry_scheduled', 'dead', 'dlq_retry', 'ready', 'cache_hit')
+EVENT_CODES = {name: code for code, name in enumerate(EVENT_TYPES, 1)}
+# the optional numeric details of an event, in column order
+EVENT_FIELDS = ('worker', 'attempt', 'delay', 'exit_code', 'upstream')
+
+# function to make a database
+# 3 db : jobs, config, workers
+# returns the number of duplicate external ids the migration had to clear
+def make_db():
+   
+    conn=sqlite3.connect(dp_path)
+    cur=conn.cursor()
+    # jobs : to store the jobs in the database
+    cur.execute(_JOBS_DDL)
     # config : to store the config values in the database
     cur.execute('''
         CREATE TABLE IF NOT EXISTS config (
@@ -31,6 +74,7 @@ def make_db():
     cur.execute('''
         CREATE TABLE IF NOT EXISTS workers (
             worker_id TEXT PRIMARY KEY,
+            num INTEGER,
             pid INTEGER,
             started_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
             last_heartbeat DATETIME,
@@ -38,84 +82,484 @@ def make_db():
         )
     ''')
     # events : to store history of job lifecycle
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            job_id INTEGER,
-            event TEXT NOT NULL,
-            detail TEXT,
-            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+    cur.execute(_EVENTS_DDL)
     conn.commit()
     conn.close()
 
+    # the other shards only carry jobs and events
+    for shard in range(1, shard_count()):
+        conn, cur = connect_db(shard)
+        try:
+            cur.execute(_JOBS_DDL)
+            cur.execute(_EVENTS_DDL)
+            conn.commit()
+        finally:
+            conn.close()
+
+    # WAL lets readers (a backup, stats) run next to a writer, so a commit never
+    # waits for a long read to finish; the mode is stored in the file
+    for shard in range(shard_count()):
+        conn, cur = connect_db(shard)
+        try:
+            # the pragma has to be stepped to completion, or the switch is left half done
+            cur.execute('PRAGMA journal_mode=WAL').fetchone()
+        finally:
+            conn.close()
+
     # ensure schema migrations (idempotent)
-    _ensure_jobs_external_id()
+    cleared = _ensure_jobs_external_id()
+    _ensure_jobs_lease()
+    _ensure_job_deps()
+    _ensure_result_cache()
+    _ensure_worker_numbers()
+    _ensure_compact_events()
+    # per-job resource limits as json (cpu_affinity, nice, memory_mb, cpu_seconds)
+    _ensure_jobs_column('limits', 'TEXT')
+    return cleared
+
+
+# function to get the number of shards (config key 'shards', re-read every SHARDS_REFRESH seconds)
+def shard_count() -> int:
+    global _shards, _shards_read_at
+    now = time.monotonic()
+    if _shards is None or now - _shards_read_at >= SHARDS_REFRESH:
+        try:
+            _shards = max(1, int(get_config('shards', '1') or 1))
+            _shards_read_at = now
+        except (sqlite3.Error, ValueError):
+            return _shards or 1
+    return _shards
+
+
+# function to get the database file of a shard (of the live database, or of
+# another one such as a backup when base is given)
+def shard_path(shard: int = 0, base: str | None = None) -> str:
+    base = base or dp_path
+    if shard == 0:
+        return base
+    root, ext = os.path.splitext(base)
+    return f'{root}.{shard}{ext}'
+
+
+# function to get the shard a job id lives in
+def shard_for_job(job_id: int) -> int:
+    return int(job_id) % shard_count()
+
+
+# function to get the shard a string key (external id, worker id) hashes to
+def shard_for_key(key: str) -> int:
+    return zlib.crc32(str(key).encode()) % shard_count()
+
+
+# function to get the shard for a new job: external ids hash to a fixed
+# shard (so lookups by external id hit one file), anything else goes to a random
+# shard (a per-process counter would put every one-job cli enqueue in shard 0)
+def shard_for_new_job(external_id: str | None = None) -> int:
+    if shard_count() == 1:
+        return 0
+    if external_id is not None:
+        return shard_for_key(external_id)
+    return random.randrange(shard_count())
+
+
+# function to list all shards starting from a preferred one (worker affinity)
+def shard_order(start: int = 0):
+    n = shard_count()
+    return [(start + i) % n for i in range(n)]
+
+
+# function to change the shard count, only allowed while there are no jobs
+# because a job's shard is derived from its id
+def set_shard_count(n: int):
+    global _shards
+    n = int(n)
+    if n < 1:
+        raise ValueError('shards must be >= 1')
+    make_db()
+    if sum(counts_by_state().values()):
+        raise ValueError('shards can only be changed on an empty queue')
+    set_config('shards', str(n))
+    _shards = None
+    make_db()
 
 
 # function to connect the database
-def connect_db():
-    conn=sqlite3.connect(dp_path)
+def connect_db(shard: int = 0):
+    conn=sqlite3.connect(shard_path(shard))
     cur=conn.cursor()
     return conn, cur
 
 
+def _ensure_jobs_column(name: str, decl: str):
+    for shard in range(shard_count()):
+        conn, cur = connect_db(shard)
+        try:
+            cur.execute("PRAGMA table_info(jobs)")
+            cols = [r[1] for r in cur.fetchall()]
+            if name not in cols:
+                try:
+                    cur.execute(f"ALTER TABLE jobs ADD COLUMN {name} {decl}")
+                    conn.commit()
+                except Exception:
+                    pass
+        finally:
+            conn.close()
+
+
+# external ids are unique so enqueue can be idempotent and lookups use the index;
+# returns the number of newer jobs whose duplicate external id was cleared
 def _ensure_jobs_external_id():
+    _ensure_jobs_column('external_id', 'TEXT')
+    cleared = 0
+    for shard in range(shard_count()):
+        conn, cur = connect_db(shard)
+        try:
+            try:
+                cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_external_id ON jobs(external_id) WHERE external_id IS NOT NULL')
+            except sqlite3.IntegrityError:
+                # databases from before the index can hold an external id twice;
+                # the oldest job keeps it (that is the one lookups used to return)
+                cur.execute(
+                    "UPDATE jobs SET external_id=NULL WHERE external_id IS NOT NULL AND id NOT IN "
+                    "(SELECT MIN(id) FROM jobs WHERE external_id IS NOT NULL GROUP BY external_id)"
+                )
+                cleared += cur.rowcount
+                cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_external_id ON jobs(external_id) WHERE external_id IS NOT NULL')
+            conn.commit()
+        finally:
+            conn.close()
+    return cleared
+
+
+# lease columns are used by the broker: a claimed job belongs to lease_owner
+# until lease_expires_at, after which it can be claimed again
+def _ensure_jobs_lease():
+    _ensure_jobs_column('lease_owner', 'TEXT')
+    _ensure_jobs_column('lease_expires_at', 'DATETIME')
+    for shard in range(shard_count()):
+        conn, cur = connect_db(shard)
+        try:
+            cur.execute('CREATE INDEX IF NOT EXISTS idx_jobs_state_created ON jobs(state, created_at)')
+            conn.commit()
+        finally:
+            conn.close()
+
+
+# dependencies: job_deps holds one edge per (upstream, dependent) in the upstream's
+# shard, keyed so the dependents of a job are one index range; remaining_deps counts
+# the upstream jobs a dependent still waits for and it stays 'blocked' until it is 0
+def _ensure_job_deps():
+    _ensure_jobs_column('remaining_deps', 'INTEGER NOT NULL DEFAULT 0')
+    for shard in range(shard_count()):
+        conn, cur = connect_db(shard)
+        try:
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS job_deps (
+                    depends_on INTEGER NOT NULL,
+                    job_id INTEGER NOT NULL,
+                    PRIMARY KEY (depends_on, job_id)
+                ) WITHOUT ROWID
+            ''')
+            conn.commit()
+        finally:
+            conn.close()
+
+
+# result cache: jobs enqueued with cache_ttl store their result keyed by a hash of
+# command and environment, so an identical job within the ttl completes without
+# running. the cache lives in the main database and is bounded (LRU on last_used)
+def _ensure_result_cache():
+    _ensure_jobs_column('cache_ttl', 'INTEGER')
+    conn, cur = connect_db()
+    try:
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS result_cache (
+                key TEXT PRIMARY KEY,
+                exit_code INTEGER NOT NULL,
+                output TEXT,
+                created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                expires_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_result_cache_last_used ON result_cache(last_used)')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# workers get a small number on registration so events can refer to them
+# with an integer instead of repeating the worker id string
+def _ensure_worker_numbers():
     conn, cur = connect_db()
     try:
-        cur.execute("PRAGMA table_info(jobs)")
-        cols = [r[1] for r in cur.fetchall()]
-        if 'external_id' not in cols:
+        cur.execute("PRAGMA table_info(workers)")
+        if 'num' not in [r[1] for r in cur.fetchall()]:
             try:
-                cur.execute("ALTER TABLE jobs ADD COLUMN external_id TEXT")
-                conn.commit()
+                cur.execute('ALTER TABLE workers ADD COLUMN num INTEGER')
+                cur.execute('UPDATE workers SET num=rowid')
             except Exception:
                 pass
+        cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_workers_num ON workers(num)')
+        conn.commit()
     finally:
         conn.close()
 
 
+# events are read per job (history --events --job-id) and by time range, so both
+# are index lookups. databases with the old text events table are converted in place
+def _ensure_compact_events():
+    for shard in range(shard_count()):
+        conn, cur = connect_db(shard)
+        try:
+            cur.execute("PRAGMA table_info(events)")
+            if 'detail' in [r[1] for r in cur.fetchall()]:
+                _migrate_events(conn, cur)
+            cur.execute('CREATE INDEX IF NOT EXISTS idx_events_job_created ON events(job_id, created_at)')
+            cur.execute('CREATE INDEX IF NOT EXISTS idx_events_created ON events(created_at)')
+            conn.commit()
+        finally:
+            conn.close()
+
+
+# function to copy an old (event TEXT, detail TEXT) events table into the compact one;
+# details looked like "worker=..., exit=0", "attempts=2, delay=4" or "upstream=7"
+def _migrate_events(conn, cur):
+    # worker numbers are assigned on shard 0 first, outside this shard's write lock
+    cur.execute("SELECT DISTINCT detail FROM events WHERE detail LIKE 'worker=%'")
+    names = {_parse_event_detail(r[0]).get('worker') for r in cur.fetchall()}
+    nums = {name: worker_number(name) for name in names if name}
+    cur.execute('BEGIN IMMEDIATE')
+    cur.execute("PRAGMA table_info(events)")
+    if 'detail' not in [r[1] for r in cur.fetchall()]:
+        conn.rollback()
+        return
+    cur.execute('ALTER TABLE events RENAME TO events_old')
+    cur.execute(_EVENTS_DDL)
+    read = conn.cursor()
+    read.execute(
+        "SELECT id, job_id, event, detail, "
+        "COALESCE(CAST(strftime('%s', created_at) AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER)) "
+        "FROM events_old ORDER BY id"
+    )
+    while True:
+        rows = read.fetchmany(1000)
+        if not rows:
+            break
+        new_rows = []
+        for event_id, job_id, event, detail, created_at in rows:
+            if event not in EVENT_CODES:
+                continue
+            fields = _parse_event_detail(detail)
+            new_rows.append((
+                event_id, job_id, EVENT_CODES[event], nums.get(fields.get('worker')),
+                _int_or_none(fields.get('attempts')), _int_or_none(fields.get('delay')),
+                _int_or_none(fields.get('exit')), _int_or_none(fields.get('upstream')), created_at,
+            ))
+        cur.executemany(
+            'INSERT INTO events(id, job_id, type, worker, attempt, delay, exit_code, upstream, created_at) '
+            'VALUES(?,?,?,?,?,?,?,?,?)',
+            new_rows,
+        )
+    cur.execute('DROP TABLE events_old')
+    conn.commit()
+
+
+def _parse_event_detail(detail) -> dict:
+    fields = {}
+    for part in (detail or '').split(', '):
+        key, _, value = part.partition('=')
+        fields[key] = value
+    return fields
+
+
+def _int_or_none(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+# what happens to the dependents of a job that goes dead (config key 'dependency_failure'):
+# 'block' keeps them blocked until the upstream is retried from the DLQ and completes,
+# 'cascade' moves every blocked job downstream of it to the DLQ as well
+DEPENDENCY_FAILURE_RULES = ('block', 'cascade')
+
+
+def dependency_failure_rule() -> str:
+    rule = get_config('dependency_failure', 'block')
+    return rule if rule in DEPENDENCY_FAILURE_RULES else 'block'
+
+
 # function to add a job to the database
-def add_job(command, state='pending', max_retires=3, external_id=None):
+# on_conflict decides what enqueueing an external_id that already exists does:
+# 'return' leaves the existing job alone, 'update' overwrites its command and retries.
+# either way the existing job's id is returned
+def add_job(command, state='pending', max_retires=3, external_id=None, on_conflict='return'):
     try:
-        
-        conn, cur=connect_db()
-        # inserting the job into the database
-        _ensure_jobs_external_id()
-        cur.execute('INSERT INTO jobs (command, state, max_retires, external_id) VALUES (?, ?, ?, ?)', (command, state, max_retires, external_id))
-        conn.commit()
-        job_id = cur.lastrowid
-        conn.close()
-        return job_id
+        job = {'command': command, 'state': state, 'max_retires': max_retires, 'external_id': external_id}
+        return add_jobs([job], on_conflict)[0][0]
     except sqlite3.Error as e:
         print(f"Error adding job: {e}")
+        return None
+
+
+_CONFLICT_SQL = {
+    'return': ' ON CONFLICT(external_id) WHERE external_id IS NOT NULL DO NOTHING',
+    'update': (
+        ' ON CONFLICT(external_id) WHERE external_id IS NOT NULL DO UPDATE SET'
+        ' command=excluded.command, max_retires=excluded.max_retires, cache_ttl=excluded.cache_ttl, limits=excluded.limits,'
+        ' updated_at=CURRENT_TIMESTAMP'
+    ),
+}
+
+
+# the next id of a shard is the smallest id above the highest one it ever used
+# that is congruent to the shard number, so ids stay unique across files and
+# id % shard_count() finds the file again, even when the sequence was left behind
+# by an earlier shard count (params: shard, n, n, n)
+_NEXT_SHARD_ID = (
+    "(SELECT s + 1 + ((? - s - 1) % ? + ?) % ? "
+    "FROM (SELECT COALESCE(MAX(seq), 0) AS s FROM sqlite_sequence WHERE name='jobs'))"
+)
+
+
+# function to add many jobs with one transaction per shard
+# jobs: dicts with command and optional state, max_retires, external_id and
+# depends_on (job ids or external ids, which may name jobs earlier in the same batch)
+# returns [(job_id, created)] in input order, created is False for an existing external_id
+def add_jobs(jobs, on_conflict='return'):
+    if on_conflict not in _CONFLICT_SQL:
+        raise ValueError(f"on_conflict must be one of: {', '.join(_CONFLICT_SQL)}")
+    n = shard_count()
+    if n == 1:
+        insert = 'INSERT INTO jobs (command, state, max_retires, external_id, remaining_deps, cache_ttl, limits) VALUES (?, ?, ?, ?, ?, ?, ?)'
+    else:
+        insert = (
+            "INSERT INTO jobs (id, command, state, max_retires, external_id, remaining_deps, cache_ttl, limits) "
+            f"VALUES ({_NEXT_SHARD_ID}, ?, ?, ?, ?, ?, ?, ?)"
+        )
+    insert += _CONFLICT_SQL[on_conflict]
+
+    placement = [shard_for_new_job(job.get('external_id')) for job in jobs]
+    needed = set(placement)
+    has_deps = False
+    for job in jobs:
+        for dep in job.get('depends_on') or ():
+            needed.add(_dependency_shard(dep))
+            has_deps = True
+    cascade = has_deps and dependency_failure_rule() == 'cascade'
+
+    # every shard involved is locked up front in a fixed order, so two
+    # enqueuers can never wait for each other
+    txns = {}
+    results = []
+    try:
+        for shard in sorted(needed):
+            conn, cur = connect_db(shard)
+            txns[shard] = (conn, cur)
+            cur.execute('BEGIN IMMEDIATE')
+        # ids above the sequence at the start of the transaction are new jobs
+        seq_before = {}
+        for shard, (conn, cur) in txns.items():
+            cur.execute("SELECT seq FROM sqlite_sequence WHERE name='jobs'")
+            row = cur.fetchone()
+            seq_before[shard] = row[0] if row else 0
+        created_ids = set()
+
+        for job, shard in zip(jobs, placement):
+            cur = txns[shard][1]
+            # upstream jobs that are not completed yet block the new job
+            waiting = {}
+            for dep in job.get('depends_on') or ():
+                dep_id, dep_state = _resolve_dependency(txns, dep)
+                if dep_state != 'completed':
+                    waiting[dep_id] = dep_state
+            state = job.get('state') or 'pending'
+            if waiting and state == 'pending':
+                state = 'dead' if cascade and 'dead' in waiting.values() else 'blocked'
+
+            limits = json.dumps(job['limits']) if job.get('limits') else None
+            values = (job['command'], state, job.get('max_retires', 3), job.get('external_id'), len(waiting), job.get('cache_ttl'), limits)
+            if n > 1:
+                values = (shard, n, n, n) + values
+            cur.execute(insert, values)
+            if job.get('external_id') is None:
+                job_id, created = cur.lastrowid, True
+            else:
+                inserted = cur.rowcount == 1
+                cur.execute('SELECT id FROM jobs WHERE external_id=?', (job['external_id'],))
+                job_id = cur.fetchone()[0]
+                created = inserted and job_id > seq_before[shard] and job_id not in created_ids
+            # an existing job keeps the dependencies it was created with
+            if created:
+                created_ids.add(job_id)
+                for dep_id in waiting:
+                    txns[shard_for_job(dep_id)][1].execute(
+                        'INSERT OR IGNORE INTO job_deps(depends_on, job_id) VALUES(?, ?)', (dep_id, job_id),
+                    )
+            results.append((job_id, created))
+        for conn, cur in txns.values():
+            conn.commit()
+    except Exception:
+        for conn, cur in txns.values():
+            conn.rollback()
+        raise
+    finally:
+        for conn, cur in txns.values():
+            conn.close()
+    return results
+
+
+# a dependency is a job id (int) or an external id (str)
+def _dependency_shard(dep) -> int:
+    return shard_for_job(dep) if isinstance(dep, int) else shard_for_key(dep)
+
+
+def _resolve_dependency(txns, dep):
+    cur = txns[_dependency_shard(dep)][1]
+    if isinstance(dep, int):
+        cur.execute('SELECT id, state FROM jobs WHERE id=?', (dep,))
+    else:
+        cur.execute('SELECT id, state FROM jobs WHERE external_id=?', (str(dep),))
+    row = cur.fetchone()
+    if not row:
+        raise ValueError(f'unknown dependency {dep!r}')
+    return row
+
+
+# function to run the same query on every shard and return the rows of each
+def _query_shards(sql: str, params=()):
+    results = []
+    for shard in range(shard_count()):
+        conn, cur = connect_db(shard)
         try:
+            cur.execute(sql, params)
+            results.append(cur.fetchall())
+        finally:
             conn.close()
-        except Exception:
-            pass
-        return None
+    return results
+
 
 # function to list the jobs in the database
 def list_jobs(state=None):
-    conn, cur = connect_db()
-    try:
-        # if the state is provided, then we are filtering the jobs by the state
-        # otherwise, we are listing all the jobs
-        if state:
-            cur.execute('SELECT id, command, state, attempts, max_retires, created_at, updated_at FROM jobs WHERE state=? ORDER BY created_at', (state,))
-        else:
-            cur.execute('SELECT id, command, state, attempts, max_retires, created_at, updated_at FROM jobs ORDER BY created_at')
-        rows = cur.fetchall()
-        return rows
-    finally:
-        conn.close()
+    # if the state is provided, then we are filtering the jobs by the state
+    # otherwise, we are listing all the jobs
+    if state:
+        parts = _query_shards('SELECT id, command, state, attempts, max_retires, created_at, updated_at FROM jobs WHERE state=? ORDER BY created_at, id', (state,))
+    else:
+        parts = _query_shards('SELECT id, command, state, attempts, max_retires, created_at, updated_at FROM jobs ORDER BY created_at, id')
+    if len(parts) == 1:
+        return parts[0]
+    # every shard is already sorted, so merging keeps the global created_at order
+    return list(heapq.merge(*parts, key=lambda r: (r[5], r[0])))
 
 # function to get a job from the database
 # job_id: the id of the job to get
 def get_job(job_id: int):
     # connecting to the database
-    conn, cur = connect_db()
+    conn, cur = connect_db(shard_for_job(job_id))
     try:
         cur.execute('SELECT id, command, state, attempts, max_retires, created_at, updated_at FROM jobs WHERE id=?', (job_id,))
         return cur.fetchone()
@@ -124,7 +568,7 @@ def get_job(job_id: int):
 
 
 def get_job_by_external_id(external_id: str):
-    conn, cur = connect_db()
+    conn, cur = connect_db(shard_for_key(external_id))
     try:
         cur.execute('SELECT id, command, state, attempts, max_retires, created_at, updated_at FROM jobs WHERE external_id=?', (external_id,))
         return cur.fetchone()
@@ -133,26 +577,31 @@ def get_job_by_external_id(external_id: str):
 
 # function to get the counts of the jobs in the database
 def counts_by_state():
-    conn, cur = connect_db()
-    try:
-        # counting the jobs by the state
-        cur.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")
-        rows = cur.fetchall()
-        counts = {'pending': 0, 'processing': 0, 'completed': 0, 'failed': 0, 'dead': 0}
-        # counting the jobs by the state
+    counts = {'pending': 0, 'blocked': 0, 'processing': 0, 'completed': 0, 'failed': 0, 'dead': 0}
+    # counting the jobs by the state, summed over the shards
+    for rows in _query_shards("SELECT state, COUNT(*) FROM jobs GROUP BY state"):
         for state, cnt in rows:
-            counts[state] = cnt
-        return counts
-    finally:
-        conn.close()
+            counts[state] = counts.get(state, 0) + cnt
+    return counts
+
+
+# function to count the pending jobs; unlike counts_by_state this only reads
+# the pending range of idx_jobs_state_created (used by the autoscaler)
+def count_pending() -> int:
+    return sum(rows[0][0] for rows in _query_shards("SELECT COUNT(*) FROM jobs WHERE state='pending'"))
 
 
 # function to retry a job in the dead letter queue
 def retry_dead(job_id: int):
-    conn, cur = connect_db()
+    conn, cur = connect_db(shard_for_job(job_id))
     try:
         # updating the job in the database
-        cur.execute("UPDATE jobs SET state='pending', attempts=0, updated_at=CURRENT_TIMESTAMP WHERE id=? AND state='dead'", (job_id,))
+        # a job that still waits for upstream jobs goes back to blocked, not pending
+        cur.execute(
+            "UPDATE jobs SET state=CASE WHEN remaining_deps > 0 THEN 'blocked' ELSE 'pending' END, attempts=0, "
+            "updated_at=CURRENT_TIMESTAMP WHERE id=? AND state='dead'",
+            (job_id,),
+        )
         conn.commit()
         return cur.rowcount == 1
     finally:
@@ -175,15 +624,494 @@ def retry_dead_by_identifier(identifier: str):
     return retry_dead(jid)
 
 
-def list_dead_jobs_with_external():
+# bulk dlq operations select dead jobs with the same filter: since (went dead at or
+# after, by updated_at) and match (a glob on the command, e.g. 'curl *')
+def _dlq_where(since: str | None = None, match: str | None = None):
+    clauses = ["state='dead'"]
+    params = []
+    if since:
+        clauses.append('updated_at >= ?')
+        params.append(format_timestamp(parse_timestamp(since)))
+    if match:
+        clauses.append('command GLOB ?')
+        params.append(match)
+    return ' AND '.join(clauses), params
+
+
+# function to stream dead jobs newest first, one page per query, so nothing is
+# held in memory and no read lock is kept while the caller writes the output
+# rows: id, external_id, command, attempts, max_retires, created_at, updated_at
+def iter_dead_jobs(since: str | None = None, match: str | None = None, page: int = 1000):
+    where, params = _dlq_where(since, match)
+    parts = [_iter_dead_in_shard(shard, where, params, page) for shard in range(shard_count())]
+    if len(parts) == 1:
+        return parts[0]
+    return heapq.merge(*parts, key=lambda r: (r[6], r[0]), reverse=True)
+
+
+def _iter_dead_in_shard(shard: int, where: str, params, page: int):
+    sql = f'SELECT id, external_id, command, attempts, max_retires, created_at, updated_at FROM jobs WHERE {where}'
+    order = ' ORDER BY updated_at DESC, id DESC LIMIT ?'
+    after = ()
+    while True:
+        conn, cur = connect_db(shard)
+        try:
+            if after:
+                cur.execute(sql + ' AND (updated_at, id) < (?, ?)' + order, (*params, *after, page))
+            else:
+                cur.execute(sql + order, (*params, page))
+            rows = cur.fetchall()
+        finally:
+            conn.close()
+        yield from rows
+        if len(rows) < page:
+            return
+        after = (rows[-1][6], rows[-1][0])
+
+
+# function to count the dead jobs a bulk dlq operation would touch
+def count_dead(since: str | None = None, match: str | None = None) -> int:
+    where, params = _dlq_where(since, match)
+    return sum(part[0][0] for part in _query_shards(f'SELECT COUNT(*) FROM jobs WHERE {where}', tuple(params)))
+
+
+# function to retry every matching dead job: per shard one transaction with one
+# set-based insert of the dlq_retry events and one update. returns the number retried
+def retry_dead_jobs(since: str | None = None, match: str | None = None) -> int:
+    where, params = _dlq_where(since, match)
+    retried = 0
+    for shard in range(shard_count()):
+        conn, cur = connect_db(shard)
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+            cur.execute(f'INSERT INTO events(job_id, type) SELECT id, ? FROM jobs WHERE {where}', (EVENT_CODES['dlq_retry'], *params))
+            cur.execute(
+                "UPDATE jobs SET state=CASE WHEN remaining_deps > 0 THEN 'blocked' ELSE 'pending' END, attempts=0, "
+                f"updated_at=CURRENT_TIMESTAMP WHERE {where}",
+                params,
+            )
+            retried += cur.rowcount
+            conn.commit()
+        finally:
+            conn.close()
+    return retried
+
+
+# function to delete every matching dead job with its events. jobs still blocked on
+# a purged job lose that dependency and go to the dlq themselves (like the 'cascade'
+# rule), so they are not left waiting forever. returns the number purged
+def purge_dead(since: str | None = None, match: str | None = None) -> int:
+    where, params = _dlq_where(since, match)
+    purged = 0
+    remote = []
+    for shard in range(shard_count()):
+        conn, cur = connect_db(shard)
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+            cur.execute(f'SELECT depends_on, job_id FROM job_deps WHERE depends_on IN (SELECT id FROM jobs WHERE {where})', params)
+            edges = cur.fetchall()
+            cur.execute(f'DELETE FROM job_deps WHERE depends_on IN (SELECT id FROM jobs WHERE {where})', params)
+            cur.execute(f'DELETE FROM events WHERE job_id IN (SELECT id FROM jobs WHERE {where})', params)
+            cur.execute(f'DELETE FROM jobs WHERE {where}', params)
+            purged += cur.rowcount
+            by_upstream = {}
+            for upstream, dependent in edges:
+                by_upstream.setdefault(upstream, []).append(dependent)
+            for upstream, dependents in by_upstream.items():
+                remote += _drop_upstream(cur, shard, upstream, dependents, True)
+            conn.commit()
+        finally:
+            conn.close()
+    # dependents in other shards, each in that shard's own transaction
+    while remote:
+        other, upstream, ids, decrement = remote.pop()
+        conn, cur = connect_db(other)
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+            remote += _drop_upstream(cur, other, upstream, ids, decrement)
+            conn.commit()
+        finally:
+            conn.close()
+    return purged
+
+
+# function to take a purged upstream off its dependents in `shard` and move the
+# blocked ones (and their blocked dependents) to dead. returns the work left for
+# other shards as (shard, upstream, job ids, decrement) tuples
+def _drop_upstream(cur, shard, upstream, job_ids, decrement):
+    local, remote = _split_by_shard(shard, job_ids)
+    if decrement:
+        cur.executemany('UPDATE jobs SET remaining_deps=MAX(remaining_deps - 1, 0) WHERE id=?', [(j,) for j in local])
+    more = _cascade_dead(cur, shard, local, upstream)
+    return [(other, upstream, ids, decrement) for other, ids in remote.items()] + \
+        [(other, upstream, ids, False) for other, ids in more.items()]
+
+
+# function to get the next job and mark it as processing
+# shards are tried starting with the worker's preferred one (shard affinity)
+def next_job(shard_hint: int = 0):
+    for shard in shard_order(shard_hint):
+        job = _next_job_in_shard(shard)
+        if job:
+            return job
+    return None
+
+
+def _next_job_in_shard(shard: int):
+    conn, cur = connect_db(shard)
+    try:
+        cur.execute('BEGIN IMMEDIATE')
+        cur.execute(
+            "SELECT id, command, attempts, max_retires, cache_ttl, limits FROM jobs WHERE state='pending' ORDER BY created_at LIMIT 1"
+        )
+        row = cur.fetchone()
+        if not row:
+            conn.commit()
+            return None
+        job_id, command, attempts, max_retires, cache_ttl, limits = row
+        cur.execute(
+            "UPDATE jobs SET state='processing', updated_at=CURRENT_TIMESTAMP WHERE id=? AND state='pending'",
+            (job_id,),
+        )
+        if cur.rowcount != 1:
+            conn.rollback()
+            return None
+        conn.commit()
+        return {
+            'id': job_id,
+            'command': command,
+            'attempts': attempts,
+            'max_retires': max_retires,
+            'cache_ttl': cache_ttl,
+            'limits': json.loads(limits) if limits else None,
+        }
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        return None
+    finally:
+        conn.close()
+
+
+# function to claim up to `limit` pending jobs for a worker under a lease
+# jobs whose lease has expired (the owner died or lost the broker) are put back first
+def claim_jobs(worker_id: str, limit: int = 1, lease_seconds: int = 30, shard_hint: int = 0):
+    jobs = []
+    for shard in shard_order(shard_hint):
+        jobs += _claim_jobs_in_shard(shard, worker_id, limit - len(jobs), lease_seconds)
+        if len(jobs) >= limit:
+            break
+    return jobs
+
+
+def _claim_jobs_in_shard(shard: int, worker_id: str, limit: int, lease_seconds: int):
+    conn, cur = connect_db(shard)
+    try:
+        cur.execute('BEGIN IMMEDIATE')
+        cur.execute(
+            "UPDATE jobs SET state='pending', lease_owner=NULL, lease_expires_at=NULL, updated_at=CURRENT_TIMESTAMP "
+            "WHERE state='processing' AND lease_expires_at IS NOT NULL AND lease_expires_at < CURRENT_TIMESTAMP"
+        )
+        cur.execute(
+            "SELECT id, command, attempts, max_retires, cache_ttl, limits FROM jobs WHERE state='pending' ORDER BY created_at LIMIT ?",
+            (limit,),
+        )
+        rows = cur.fetchall()
+        if not rows:
+            conn.commit()
+            return []
+        cur.executemany(
+            "UPDATE jobs SET state='processing', lease_owner=?, lease_expires_at=datetime('now', ?), updated_at=CURRENT_TIMESTAMP "
+            "WHERE id=? AND state='pending'",
+            [(worker_id, f'+{int(lease_seconds)} seconds', r[0]) for r in rows],
+        )
+        conn.commit()
+        return [
+            {
+                'id': job_id, 'command': command, 'attempts': attempts, 'max_retires': max_retires,
+                'cache_ttl': cache_ttl, 'limits': json.loads(limits) if limits else None,
+            }
+            for job_id, command, attempts, max_retires, cache_ttl, limits in rows
+        ]
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        return []
+    finally:
+        conn.close()
+
+
+# function to extend the leases of the jobs a worker reports holding; a job the
+# worker does not know about (say a claim whose reply never arrived) is left to expire
+def extend_leases(worker_id: str, job_ids, lease_seconds: int = 30):
+    by_shard = {}
+    for job_id in job_ids:
+        by_shard.setdefault(shard_for_job(job_id), []).append(int(job_id))
+    extended = 0
+    for shard, ids in by_shard.items():
+        conn, cur = connect_db(shard)
+        try:
+            cur.executemany(
+                "UPDATE jobs SET lease_expires_at=datetime('now', ?) WHERE id=? AND state='processing' AND lease_owner=?",
+                [(f'+{int(lease_seconds)} seconds', job_id, worker_id) for job_id in ids],
+            )
+            extended += cur.rowcount
+            conn.commit()
+        finally:
+            conn.close()
+    return extended
+
+
+# function for marking the job as completed
+# its dependents are released in the same transaction (dependents in another
+# shard right after, in that shard's own transaction)
+def mark_complete(job_id: int, owner: str | None = None) -> bool:
+    shard = shard_for_job(job_id)
+    conn, cur = connect_db(shard)
+    try:
+        cur.execute('BEGIN IMMEDIATE')
+        sql, params = _owned_update("state='completed'", job_id, owner)
+        cur.execute(sql, params)
+        if cur.rowcount != 1:
+            conn.rollback()
+            return False
+        # the edges are consumed so a job that completes twice releases nothing twice
+        dependents = _dependents_of(cur, [job_id])
+        cur.execute('DELETE FROM job_deps WHERE depends_on=?', (job_id,))
+        remote = _release_dependents(cur, shard, dependents, job_id)
+        conn.commit()
+    finally:
+        conn.close()
+    for other, ids in remote.items():
+        conn, cur = connect_db(other)
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+            _release_dependents(cur, other, ids, job_id)
+            conn.commit()
+        finally:
+            conn.close()
+    return True
+
+
+# function to build the update that ends a job's run; with an owner (broker workers)
+# the job must still be processing under that worker's lease, so a worker whose
+# lease expired can't finish a job another worker has claimed since
+def _owned_update(assignments: str, job_id: int, owner: str | None = None, values=()):
+    sql = (
+        f"UPDATE jobs SET {assignments}, lease_owner=NULL, lease_expires_at=NULL, updated_at=CURRENT_TIMESTAMP WHERE id=?"
+    )
+    params = (*values, job_id)
+    if owner is not None:
+        sql += " AND state='processing' AND lease_owner=?"
+        params += (owner,)
+    return sql, params
+
+
+# function for marking the job as dead
+# with the 'cascade' dependency rule every blocked job downstream goes dead too
+def mark_dead(job_id: int, owner: str | None = None) -> bool:
+    cascade = dependency_failure_rule() == 'cascade'
+    shard = shard_for_job(job_id)
+    conn, cur = connect_db(shard)
+    try:
+        cur.execute('BEGIN IMMEDIATE')
+        sql, params = _owned_update("state='dead'", job_id, owner)
+        cur.execute(sql, params)
+        if cur.rowcount != 1:
+            conn.rollback()
+            return False
+        remote = _cascade_dead(cur, shard, _dependents_of(cur, [job_id]), job_id) if cascade else {}
+        conn.commit()
+    finally:
+        conn.close()
+    while remote:
+        other, ids = remote.popitem()
+        conn, cur = connect_db(other)
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+            more = _cascade_dead(cur, other, ids, job_id)
+            conn.commit()
+        finally:
+            conn.close()
+        for s_, ids_ in more.items():
+            remote.setdefault(s_, []).extend(ids_)
+    return True
+
+
+# function to get the dependents of some jobs (their edges are in the current shard)
+def _dependents_of(cur, job_ids):
+    found = []
+    for i in range(0, len(job_ids), 500):
+        chunk = job_ids[i:i + 500]
+        marks = ','.join('?' * len(chunk))
+        cur.execute(f'SELECT job_id FROM job_deps WHERE depends_on IN ({marks})', chunk)
+        found += [r[0] for r in cur.fetchall()]
+    return found
+
+
+# function to split job ids into the ones in `shard` and {other shard: ids}
+def _split_by_shard(shard, job_ids):
+    local, remote = [], {}
+    for jid in job_ids:
+        other = shard_for_job(jid)
+        if other == shard:
+            local.append(jid)
+        else:
+            remote.setdefault(other, []).append(jid)
+    return local, remote
+
+
+# function to count one finished upstream off each dependent in `shard`;
+# blocked jobs that reach zero become pending. returns the dependents of other shards
+def _release_dependents(cur, shard, job_ids, upstream_id):
+    local, remote = _split_by_shard(shard, job_ids)
+    for i in range(0, len(local), 500):
+        chunk = local[i:i + 500]
+        marks = ','.join('?' * len(chunk))
+        cur.execute(
+            "UPDATE jobs SET remaining_deps=MAX(remaining_deps - 1, 0), "
+            "state=CASE WHEN remaining_deps <= 1 AND state='blocked' THEN 'pending' ELSE state END, "
+            f"updated_at=CURRENT_TIMESTAMP WHERE id IN ({marks})",
+            chunk,
+        )
+        cur.execute(
+            "INSERT INTO events(job_id, type, upstream) "
+            f"SELECT id, ?, ? FROM jobs WHERE id IN ({marks}) AND state='pending' AND remaining_deps=0",
+            [EVENT_CODES['ready'], upstream_id] + chunk,
+        )
+    return remote
+
+
+# function to move blocked jobs in `shard` (and, level by level, the blocked jobs
+# downstream of them) to dead. returns the jobs of other shards still to visit
+def _cascade_dead(cur, shard, job_ids, root_id):
+    local, remote = _split_by_shard(shard, job_ids)
+    while local:
+        killed = []
+        for i in range(0, len(local), 500):
+            chunk = local[i:i + 500]
+            marks = ','.join('?' * len(chunk))
+            cur.execute(f"SELECT id FROM jobs WHERE id IN ({marks}) AND state='blocked'", chunk)
+            killed += [r[0] for r in cur.fetchall()]
+        if not killed:
+            break
+        cur.executemany("UPDATE jobs SET state='dead', updated_at=CURRENT_TIMESTAMP WHERE id=?", [(k,) for k in killed])
+        cur.executemany(
+            'INSERT INTO events(job_id, type, upstream) VALUES(?, ?, ?)',
+            [(k, EVENT_CODES['dead'], root_id) for k in killed],
+        )
+        local, more = _split_by_shard(shard, _dependents_of(cur, killed))
+        for other, ids in more.items():
+            remote.setdefault(other, []).extend(ids)
+    return remote
+
+
+# function for requeuing the job with the next attempt
+def requeue_with_attempt(job_id: int, next_attempts: int, owner: str | None = None) -> bool:
+    conn, cur = connect_db(shard_for_job(job_id))
+    try:
+        cur.execute(*_owned_update("state='pending', attempts=?", job_id, owner, (next_attempts,)))
+        conn.commit()
+        return cur.rowcount == 1
+    finally:
+        conn.close()
+
+
+# function to hand claimed jobs a worker has not started back to the queue
+# (their attempts are unchanged); returns the number released
+def release_jobs(job_ids, owner: str) -> int:
+    by_shard = {}
+    for job_id in job_ids:
+        by_shard.setdefault(shard_for_job(job_id), []).append(int(job_id))
+    sql = _owned_update("state='pending'", 0, owner)[0]
+    released = 0
+    for shard, ids in by_shard.items():
+        conn, cur = connect_db(shard)
+        try:
+            cur.executemany(sql, [(job_id, owner) for job_id in ids])
+            released += cur.rowcount
+            conn.commit()
+        finally:
+            conn.close()
+    return released
+
+
+DEFAULT_CACHE_MAX_ENTRIES = 1000
+
+
+# function to look up a cached result; returns (exit_code, output) or None
+def cache_get(key: str):
+    now = time.time()
     conn, cur = connect_db()
     try:
-        _ensure_jobs_external_id()
-        cur.execute("SELECT id, external_id, command FROM jobs WHERE state='dead' ORDER BY updated_at DESC, id DESC")
-        return cur.fetchall()
+        cur.execute('SELECT exit_code, output FROM result_cache WHERE key=? AND expires_at > ?', (key, now))
+        row = cur.fetchone()
+        # a miss writes nothing; a hit only touches its own entry (for the lru order)
+        if row:
+            cur.execute('UPDATE result_cache SET last_used=?, hits=hits+1 WHERE key=?', (now, key))
+            conn.commit()
+        return row
     finally:
         conn.close()
 
+
+# function to store a result; expired entries go first, then the least recently
+# used ones until the cache fits in the 'cache_max_entries' config value
+def cache_put(key: str, exit_code: int, output: str | None, ttl: int):
+    now = time.time()
+    max_entries = int(get_config('cache_max_entries', str(DEFAULT_CACHE_MAX_ENTRIES)) or DEFAULT_CACHE_MAX_ENTRIES)
+    conn, cur = connect_db()
+    try:
+        cur.execute('BEGIN IMMEDIATE')
+        cur.execute(
+            "INSERT INTO result_cache(key, exit_code, output, expires_at, last_used) VALUES(?,?,?,?,?) "
+            "ON CONFLICT(key) DO UPDATE SET exit_code=excluded.exit_code, output=excluded.output, "
+            "created_at=CURRENT_TIMESTAMP, expires_at=excluded.expires_at, last_used=excluded.last_used",
+            (key, exit_code, output, now + ttl, now),
+        )
+        cur.execute('DELETE FROM result_cache WHERE expires_at <= ?', (now,))
+        cur.execute('SELECT COUNT(*) FROM result_cache')
+        extra = cur.fetchone()[0] - max_entries
+        if extra > 0:
+            cur.execute('DELETE FROM result_cache WHERE key IN (SELECT key FROM result_cache ORDER BY last_used LIMIT ?)', (extra,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# function to summarize the cache: entries, live entries, hits on the current entries,
+# max entries. misses are not counted, so a lookup that misses writes nothing
+def cache_stats():
+    conn, cur = connect_db()
+    try:
+        cur.execute('SELECT COUNT(*), COALESCE(SUM(expires_at > ?), 0), COALESCE(SUM(hits), 0) FROM result_cache', (time.time(),))
+        entries, live, hits = cur.fetchone()
+    finally:
+        conn.close()
+    return {
+        'entries': entries,
+        'live': live,
+        'hits': hits,
+        'max_entries': int(get_config('cache_max_entries', str(DEFAULT_CACHE_MAX_ENTRIES)) or DEFAULT_CACHE_MAX_ENTRIES),
+    }
+
+
+# function to empty the cache (and with it the hit counts); returns the number of entries removed
+def cache_clear() -> int:
+    conn, cur = connect_db()
+    try:
+        cur.execute('DELETE FROM result_cache')
+        removed = cur.rowcount
+        conn.commit()
+        return removed
+    finally:
+        conn.close()
+
+
 # function to set a config value in the database
 
 def set_config(key: str, value: str):
@@ -207,9 +1135,9 @@ def get_config(key: str, default: str | None = None):
         conn.close()
 
 
-# function to register a worker in the database
+# function to register a worker in the database, returns the worker's number
 
-def register_worker(worker_id: str, pid: int):
+def register_worker(worker_id: str, pid: int) -> int:
     conn, cur = connect_db()
     try:
         # registering the worker in the database with the worker_id, pid, started_at, last_heartbeat, status
@@ -218,7 +1146,53 @@ def register_worker(worker_id: str, pid: int):
             "ON CONFLICT(worker_id) DO UPDATE SET pid=excluded.pid, last_heartbeat=excluded.last_heartbeat, status='running'",
             (worker_id, pid),
         )
+        num = _assign_worker_number(cur, worker_id)
+        conn.commit()
+        return num
+    finally:
+        conn.close()
+
+
+# function to get the number events use for a worker (workers seen only through
+# the broker or in old events get a row without pid/status)
+def worker_number(worker_id: str) -> int:
+    conn, cur = connect_db()
+    try:
+        cur.execute("SELECT num FROM workers WHERE worker_id=?", (worker_id,))
+        row = cur.fetchone()
+        if row and row[0] is not None:
+            return row[0]
+        cur.execute("INSERT INTO workers(worker_id) VALUES(?) ON CONFLICT(worker_id) DO NOTHING", (worker_id,))
+        num = _assign_worker_number(cur, worker_id)
         conn.commit()
+        return num
+    finally:
+        conn.close()
+
+
+# numbers are handed out inside the caller's write transaction, so they are unique
+def _assign_worker_number(cur, worker_id: str) -> int:
+    cur.execute(
+        "UPDATE workers SET num=(SELECT COALESCE(MAX(num), 0) + 1 FROM workers) WHERE worker_id=? AND num IS NULL",
+        (worker_id,),
+    )
+    cur.execute("SELECT num FROM workers WHERE worker_id=?", (worker_id,))
+    return cur.fetchone()[0]
+
+
+# function to map worker numbers back to worker ids
+def worker_names(nums) -> dict:
+    nums = [n for n in set(nums) if n is not None]
+    names = {}
+    if not nums:
+        return names
+    conn, cur = connect_db()
+    try:
+        for i in range(0, len(nums), 500):
+            chunk = nums[i:i + 500]
+            cur.execute(f"SELECT num, worker_id FROM workers WHERE num IN ({','.join('?' * len(chunk))})", chunk)
+            names.update(cur.fetchall())
+        return names
     finally:
         conn.close()
 
@@ -247,47 +1221,331 @@ def count_active_workers(threshold_seconds: int = 10) -> int:
         conn.close()
 
 
+_EVENT_INSERT = 'INSERT INTO events(job_id, type, worker, attempt, delay, exit_code, upstream) VALUES(?,?,?,?,?,?,?)'
+
+
+# function to turn (job_id, event name, *EVENT_FIELDS) into an events row
+def _event_row(job_id: int, event: str, *fields):
+    if event not in EVENT_CODES:
+        raise ValueError(f'unknown event {event!r}')
+    return (job_id, EVENT_CODES[event], *fields, *(None,) * (len(EVENT_FIELDS) - len(fields)))
+
+
 # function to add an event to the events table
-def add_event(job_id: int, event: str, detail: str | None = None):
-    conn, cur = connect_db()
+def add_event(job_id: int, event: str, worker: int | None = None, attempt: int | None = None,
+              delay: int | None = None, exit_code: int | None = None, upstream: int | None = None):
+    conn, cur = connect_db(shard_for_job(job_id))
     try:
-        # adding the event to the database with the job_id, event, detail
-        cur.execute('INSERT INTO events(job_id, event, detail) VALUES(?,?,?)', (job_id, event, detail))
+        # adding the event to the database with the job_id, event code and details
+        cur.execute(_EVENT_INSERT, _event_row(job_id, event, worker, attempt, delay, exit_code, upstream))
         conn.commit()
     finally:
         conn.close()
 
 
-# function to list events (optionally for a single job)
-def list_events(job_id: int | None = None, limit: int | None = 100, since: str | None = None, until: str | None = None, order: str = 'desc'):
-    conn, cur = connect_db()
+# function to add many events, one transaction per shard
+# events: (job_id, event, *EVENT_FIELDS) tuples, trailing fields can be left out
+def add_events(events):
+    by_shard = {}
+    for ev in events:
+        by_shard.setdefault(shard_for_job(ev[0]), []).append(_event_row(*ev))
+    for shard, rows in by_shard.items():
+        conn, cur = connect_db(shard)
+        try:
+            cur.executemany(_EVENT_INSERT, rows)
+            conn.commit()
+        finally:
+            conn.close()
+
+
+# function to turn "YYYY-MM-DD HH:MM:SS" (sqlite/utc, optional T and Z), a date
+# or unix seconds into unix seconds
+def parse_timestamp(value) -> int:
+    s = str(value).strip().rstrip('Z').replace('T', ' ')
     try:
-        # creating a list of clauses and parameters
-        clauses = []
-        params = []
-        if job_id is not None:
-            clauses.append('job_id = ?')
-            params.append(job_id)
-        # if the since is provided, then we are filtering the events by the created_at
-        if since:
-            clauses.append('created_at >= ?')
-            params.append(since)
-        # if the until is provided, then we are filtering the events by the created_at
-        if until:
-            clauses.append('created_at <= ?')
-            params.append(until)
-        where_sql = ('WHERE ' + ' AND '.join(clauses)) if clauses else ''
-        # if the order is provided, then we are ordering the events by the created_at
-        ord = 'ASC' if str(order).lower() == 'asc' else 'DESC'
-        sql = f'SELECT id, job_id, event, detail, created_at FROM events {where_sql} ORDER BY created_at {ord}, id {ord}'
-        # if the limit is provided, then we are limiting the events by the limit
+        return int(float(s))
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(s.split('.')[0], fmt))
+        except ValueError:
+            continue
+    raise ValueError(f'invalid timestamp {value!r}')
+
+
+# function to format unix seconds the way sqlite's CURRENT_TIMESTAMP does
+def format_timestamp(seconds: int) -> str:
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds))
+
+
+# function to list events (optionally for a single job), newest first by default
+# rows: (id, job_id, event, worker, attempt, delay, exit_code, upstream, created_at)
+# with the event name, the worker id and created_at decoded
+def list_events(job_id: int | None = None, limit: int | None = 100, since: str | None = None, until: str | None = None, order: str = 'desc'):
+    # creating a list of clauses and parameters
+    clauses = []
+    params = []
+    if job_id is not None:
+        clauses.append('job_id = ?')
+        params.append(job_id)
+    # if the since is provided, then we are filtering the events by the created_at
+    if since:
+        clauses.append('created_at >= ?')
+        params.append(parse_timestamp(since))
+    # if the until is provided, then we are filtering the events by the created_at
+    if until:
+        clauses.append('created_at <= ?')
+        params.append(parse_timestamp(until))
+    where_sql = ('WHERE ' + ' AND '.join(clauses)) if clauses else ''
+    # if the order is provided, then we are ordering the events by the created_at
+    desc = str(order).lower() != 'asc'
+    ord = 'DESC' if desc else 'ASC'
+    sql = (
+        'SELECT id, job_id, type, worker, attempt, delay, exit_code, upstream, created_at '
+        f'FROM events {where_sql} ORDER BY created_at {ord}, id {ord}'
+    )
+    # if the limit is provided, then we are limiting the events by the limit
+    if isinstance(limit, int) and limit > 0:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    # a job's events live in the job's shard; otherwise every shard is merged
+    if job_id is not None:
+        conn, cur = connect_db(shard_for_job(job_id))
+        try:
+            cur.execute(sql, tuple(params))
+            rows = cur.fetchall()
+        finally:
+            conn.close()
+    else:
+        parts = _query_shards(sql, tuple(params))
+        rows = parts[0] if len(parts) == 1 else list(heapq.merge(*parts, key=lambda r: r[8], reverse=desc))
         if isinstance(limit, int) and limit > 0:
-            sql += ' LIMIT ?'
-            params.append(limit)
-        # executing the sql query
-        cur.execute(sql, tuple(params))
-        return cur.fetchall()
+            rows = rows[:limit]
+    names = worker_names(r[3] for r in rows)
+    return [
+        (r[0], r[1], EVENT_TYPES[r[2] - 1], names.get(r[3], r[3]), r[4], r[5], r[6], r[7], format_timestamp(r[8]))
+        for r in rows
+    ]
+
+
+# function to back up every shard while workers keep running. VACUUM INTO copies a
+# shard inside one read transaction, so the copy is a consistent snapshot and always
+# finishes (a stepwise backup restarts whenever another connection writes, and on a
+# busy queue never ends); in WAL mode writers keep committing during the copy.
+# shard i goes to shard_path(i, path), written under a temporary name first so a
+# failed backup leaves no partial file. returns the files written
+def backup(path: str):
+    files = []
+    for shard in range(shard_count()):
+        target = shard_path(shard, path)
+        if os.path.abspath(target) == os.path.abspath(shard_path(shard)):
+            raise ValueError('backup path must not be the live database')
+        partial = target + '.partial'
+        if os.path.exists(partial):
+            os.remove(partial)
+        conn, cur = connect_db(shard)
+        try:
+            cur.execute('VACUUM INTO ?', (partial,))
+        finally:
+            conn.close()
+        os.replace(partial, target)
+        files.append(target)
+    return files
+
+
+# columns of an exported job, in insert order (max_retires is written as max_retries)
+_EXPORT_COLUMNS = ('id', 'external_id', 'command', 'state', 'attempts', 'max_retires', 'remaining_deps', 'cache_ttl', 'limits', 'created_at', 'updated_at')
+
+
+# function to stream the queue as one dict per job, with the ids of the jobs that
+# depend on it and its events. jobs are read a page at a time per shard (by id),
+# so memory use does not grow with the queue
+def iter_export(page: int = 1000):
+    select = f"SELECT {', '.join(_EXPORT_COLUMNS)} FROM jobs WHERE id > ? ORDER BY id LIMIT ?"
+    for shard in range(shard_count()):
+        after = -1
+        while True:
+            conn, cur = connect_db(shard)
+            try:
+                cur.execute(select, (after, page))
+                jobs = cur.fetchall()
+                if not jobs:
+                    break
+                ids = [j[0] for j in jobs]
+                marks = ','.join('?' * len(ids))
+                cur.execute(f'SELECT depends_on, job_id FROM job_deps WHERE depends_on IN ({marks})', ids)
+                dependents = {}
+                for upstream, job_id in cur.fetchall():
+                    dependents.setdefault(upstream, []).append(job_id)
+                cur.execute(
+                    'SELECT job_id, type, worker, attempt, delay, exit_code, upstream, created_at '
+                    f'FROM events WHERE job_id IN ({marks}) ORDER BY job_id, created_at, id',
+                    ids,
+                )
+                events = cur.fetchall()
+            finally:
+                conn.close()
+            names = worker_names(e[2] for e in events)
+            by_job = {}
+            for e in events:
+                event = {'event': EVENT_TYPES[e[1] - 1]}
+                for name, value in zip(EVENT_FIELDS, e[2:7]):
+                    if value is not None:
+                        event[name] = names.get(value, value) if name == 'worker' else value
+                event['created_at'] = format_timestamp(e[7])
+                by_job.setdefault(e[0], []).append(event)
+            for job in jobs:
+                record = {('max_retries' if c == 'max_retires' else c): v for c, v in zip(_EXPORT_COLUMNS, job)}
+                record['limits'] = json.loads(record['limits']) if record['limits'] else None
+                record['dependents'] = dependents.get(job[0], [])
+                record['events'] = by_job.get(job[0], [])
+                yield record
+            after = ids[-1]
+
+
+# function to load exported jobs: chunks of `chunk` records, one transaction per
+# shard and chunk. a job without an external id keeps its id, so it lands in shard
+# id % shard_count() of this database whatever layout it came from. a job with an
+# external id goes to the shard add_jobs would pick for it (shard_for_new_job) and
+# keeps its id only if that id belongs to the shard and is free; otherwise it is
+# spooled to a temporary file and numbered in that shard after the whole stream is
+# in, so a new id never takes the id of a job further down the stream. dependency
+# edges and event upstreams are written last, rewritten to the new ids.
+# a job that already exists (same id or external id, same command) is skipped with
+# its events, so an import can be re-run; a job whose id or external id is held by
+# a different job is a conflict and is skipped too. jobs that were processing are
+# made pending again. returns (imported, skipped, conflicting record ids)
+def import_jobs(records, chunk: int = 1000):
+    ctx = {'worker_nums': {}, 'id_map': {}, 'edges': [], 'events': [], 'conflicts': []}
+    imported = total = 0
+    with tempfile.TemporaryFile('w+') as spool:
+        ctx['spool'] = spool
+        for batch in _chunks(records, chunk):
+            imported += _import_batch(batch, ctx)
+            total += len(batch)
+        ctx['spool'] = None
+        spool.seek(0)
+        for batch in _chunks((json.loads(line) for line in spool), chunk):
+            imported += _import_batch(batch, ctx)
+    _import_links(ctx)
+    return imported, total - imported - len(ctx['conflicts']), ctx['conflicts']
+
+
+def _chunks(items, size: int):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _import_batch(records, ctx) -> int:
+    # worker numbers live in shard 0, so they are assigned before any shard is locked
+    worker_nums = ctx['worker_nums']
+    for record in records:
+        for event in record.get('events') or ():
+            name = event.get('worker')
+            if name is not None and name not in worker_nums:
+                worker_nums[name] = worker_number(str(name))
+    by_shard = {}
+    for record in records:
+        if record.get('id') is None or not record.get('command'):
+            raise ValueError(f'job record needs an id and a command: {record!r}')
+        external_id = record.get('external_id')
+        shard = shard_for_new_job(external_id) if external_id is not None else shard_for_job(record['id'])
+        by_shard.setdefault(shard, []).append(record)
+    return sum(_import_into_shard(shard, rows, ctx) for shard, rows in sorted(by_shard.items()))
+
+
+def _import_into_shard(shard: int, records, ctx) -> int:
+    n = shard_count()
+    columns = 'external_id, command, state, attempts, max_retires, remaining_deps, cache_ttl, limits, created_at, updated_at'
+    values = '?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), COALESCE(?, CURRENT_TIMESTAMP)'
+    # while spooling, ids are kept; afterwards the spooled jobs are numbered like add_jobs does
+    if ctx['spool'] is not None:
+        insert, id_params = f'INSERT INTO jobs (id, {columns}) VALUES (?, {values})', None
+    elif n == 1:
+        insert, id_params = f'INSERT INTO jobs ({columns}) VALUES ({values})', ()
+    else:
+        insert = f"INSERT INTO jobs (id, {columns}) VALUES ({_NEXT_SHARD_ID}, {values})"
+        id_params = (shard, n, n, n)
+    added = 0
+    conn, cur = connect_db(shard)
+    try:
+        cur.execute('BEGIN IMMEDIATE')
+        for r in records:
+            old_id = int(r['id'])
+            external_id = r.get('external_id')
+            if external_id is not None:
+                cur.execute('SELECT id, command FROM jobs WHERE external_id=?', (external_id,))
+                row = cur.fetchone()
+                if row:
+                    if row[1] != r['command']:
+                        ctx['conflicts'].append(old_id)
+                    elif row[0] != old_id:
+                        ctx['id_map'][old_id] = row[0]
+                    continue
+            if id_params is None:
+                cur.execute('SELECT external_id, command FROM jobs WHERE id=?', (old_id,))
+                row = cur.fetchone()
+                if external_id is not None and (row or shard_for_job(old_id) != shard):
+                    ctx['spool'].write(json.dumps(r) + '\n')
+                    continue
+                if row:
+                    if row != (None, r['command']):
+                        ctx['conflicts'].append(old_id)
+                    continue
+            state = 'pending' if r.get('state') == 'processing' else (r.get('state') or 'pending')
+            fields = (
+                external_id, r['command'], state, int(r.get('attempts') or 0),
+                int(r.get('max_retries', r.get('max_retires')) or 3), int(r.get('remaining_deps') or 0),
+                r.get('cache_ttl'), json.dumps(r['limits']) if r.get('limits') else None,
+                r.get('created_at'), r.get('updated_at'),
+            )
+            cur.execute(insert, ((old_id,) if id_params is None else id_params) + fields)
+            job_id = old_id if id_params is None else cur.lastrowid
+            if job_id != old_id:
+                ctx['id_map'][old_id] = job_id
+            added += 1
+            ctx['edges'] += [(job_id, int(d)) for d in r.get('dependents') or ()]
+            rows = [
+                _event_row(job_id, e['event'], ctx['worker_nums'].get(e.get('worker')), e.get('attempt'), e.get('delay'),
+                           e.get('exit_code'), e.get('upstream'))
+                + (parse_timestamp(e['created_at']) if e.get('created_at') else int(time.time()),)
+                for e in r.get('events') or ()
+            ]
+            # events naming an upstream job wait until every new id is known
+            ctx['events'] += [row for row in rows if row[6] is not None]
+            cur.executemany(_IMPORT_EVENT_INSERT, [row for row in rows if row[6] is None])
+        conn.commit()
+        return added
     finally:
         conn.close()
 
 
+_IMPORT_EVENT_INSERT = 'INSERT INTO events(job_id, type, worker, attempt, delay, exit_code, upstream, created_at) VALUES(?,?,?,?,?,?,?,?)'
+
+
+# function to write the dependency edges and upstream events of an import, with
+# old ids mapped to the ids the jobs got in this database
+def _import_links(ctx):
+    id_map = ctx['id_map']
+    by_shard = {}
+    for upstream, dependent in ctx['edges']:
+        by_shard.setdefault(shard_for_job(upstream), ([], []))[0].append((upstream, id_map.get(dependent, dependent)))
+    for row in ctx['events']:
+        row = row[:6] + (id_map.get(row[6], row[6]),) + row[7:]
+        by_shard.setdefault(shard_for_job(row[0]), ([], []))[1].append(row)
+    for shard, (edges, events) in sorted(by_shard.items()):
+        conn, cur = connect_db(shard)
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+            cur.executemany('INSERT OR IGNORE INTO job_deps(depends_on, job_id) VALUES(?, ?)', edges)
+            cur.executemany(_IMPORT_EVENT_INSERT, events)
+            conn.commit()
+        finally:
+            conn.close()
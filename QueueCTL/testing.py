@@ -3,10 +3,17 @@ import sys
 import time
 import json
 import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import zlib
 import subprocess
 
 import storage
 import worker
+import broker
+import backends
 
 
 def run_cli(args):
@@ -31,8 +38,12 @@ def ensure_fresh_db():
     db = 'queuectl.db'
     if os.environ.get('KEEP_DB'):
         return
-    if os.path.exists(db):
-        shutil.move(db, db + '.bak')
+    # a sharded layout has one extra file per shard next to queuectl.db
+    paths = [storage.shard_path(i) for i in range(storage.shard_count())]
+    for path in paths:
+        if os.path.exists(path):
+            shutil.move(path, path + '.bak')
+    storage._shards = None
     storage.make_db()
 
 
@@ -71,6 +82,90 @@ def main():
     ok_id = int(out.strip().split()[-1])
     assert wait_for(lambda: (read_job(ok_id) or [None, None, ''])[2] == 'completed', 5.0)
 
+    # 3b) a repeated id returns the existing job instead of enqueueing it twice
+    print_section('idempotent enqueue')
+    payload = '{"id":"idem-1","command":"python -c \\\"print(1)\\\""}'
+    rc, out, err = run_cli(['enqueue', payload])
+    assert rc == 0 and out.strip().startswith('enqueued ')
+    idem_id = int(out.strip().split()[1])
+    rc, out, err = run_cli(['enqueue', payload])
+    assert rc == 0 and out.strip() == f'enqueued {idem_id} (existing)'
+    assert storage.get_job_by_external_id('idem-1')[0] == idem_id
+    # an old database with a duplicated external id is migrated, and the cli reports it
+    tmp = tempfile.mkdtemp()
+    try:
+        conn = sqlite3.connect(os.path.join(tmp, 'queuectl.db'))
+        conn.execute(storage._JOBS_DDL)
+        conn.execute('ALTER TABLE jobs ADD COLUMN external_id TEXT')
+        conn.executemany("INSERT INTO jobs(command, state, external_id) VALUES ('echo x', 'completed', 'dup')", [(), ()])
+        conn.commit()
+        conn.close()
+        proc = subprocess.run([sys.executable, os.path.abspath('queuectl.py'), 'status'], capture_output=True, text=True, cwd=tmp)
+        assert proc.returncode == 0 and 'cleared duplicate external_id on 1 newer job(s)' in proc.stderr, proc.stderr
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    # 3c) dependencies: the downstream job stays blocked until its upstream completes
+    print_section('dependencies')
+    payload = json.dumps([
+        {'id': 'dag-up', 'command': 'python -c "import time; time.sleep(1)"'},
+        {'id': 'dag-down', 'command': 'python -c "print(2)"', 'depends_on': ['dag-up']},
+    ])
+    rc, out, err = run_cli(['enqueue', payload])
+    assert rc == 0, err
+    up_id, down_id = [int(line.split()[1]) for line in out.strip().splitlines()]
+    assert (read_job(down_id) or [None, None, ''])[2] == 'blocked'
+    assert wait_for(lambda: (read_job(down_id) or [None, None, ''])[2] == 'completed', 6.0)
+    assert read_job(up_id)[2] == 'completed'
+    # depends_on has to be a list of ids
+    for deps in ('"dag-up"', '5'):
+        rc, out, err = run_cli(['enqueue', '{"command":"echo x","depends_on":%s}' % deps])
+        assert rc != 0 and 'invalid job' in err and 'depends_on' in err, err
+
+    # 3d) result cache: a second identical job inside cache_ttl completes from the cache
+    print_section('result cache')
+    run_cli(['cache', 'clear'])
+    payload = '{"command":"python -c \\\"print(42)\\\"","cache_ttl":60}'
+    cached_ids = []
+    for _ in range(2):
+        rc, out, err = run_cli(['enqueue', payload])
+        assert rc == 0, err
+        cached_ids.append(int(out.strip().split()[-1]))
+        assert wait_for(lambda: (read_job(cached_ids[-1]) or [None, None, ''])[2] == 'completed', 5.0)
+    assert any(e[2] == 'cache_hit' for e in storage.list_events(job_id=cached_ids[1]))
+    rc, out, err = run_cli(['cache', 'stats'])
+    assert rc == 0 and 'hits: 1' in out
+    rc, out, err = run_cli(['enqueue', '{"command":"echo x","cache_ttl":-5}'])
+    assert rc != 0 and 'cache_ttl' in err
+    # only the allow-listed environment variables are part of the key
+    key = worker.func_cache_key('echo x')
+    os.environ['QUEUECTL_TEST_SESSION'] = 'abc'
+    assert worker.func_cache_key('echo x') == key
+    del os.environ['QUEUECTL_TEST_SESSION']
+
+    # 3e) resource limits: applied to the job's command, a job over its memory limit fails
+    if os.name == 'posix':
+        print_section('resource limits')
+        check = "import os, sys; ok = os.nice(0) >= 1 and (not hasattr(os, 'sched_getaffinity') or os.sched_getaffinity(0) == {0}); sys.exit(0 if ok else 1)"
+        rc, out, err = run_cli(['enqueue', json.dumps({'command': f'python -c "{check}"', 'cpu_affinity': '0', 'nice': 1, 'max_retries': 1})])
+        assert rc == 0, err
+        limited_id = int(out.strip().split()[-1])
+        rc, out, err = run_cli(['enqueue', json.dumps({'command': 'python -c "bytearray(512 * 1024 * 1024)"', 'memory_mb': 128, 'max_retries': 1})])
+        assert rc == 0, err
+        hog_id = int(out.strip().split()[-1])
+        assert wait_for(lambda: (read_job(limited_id) or [None, None, ''])[2] == 'completed', 5.0)
+        assert wait_for(lambda: (read_job(hog_id) or [None, None, ''])[2] == 'dead', 5.0)
+        rc, out, err = run_cli(['enqueue', json.dumps({'command': 'echo x', 'memory_mb': -1})])
+        assert rc != 0 and 'memory_mb' in err
+        if os.geteuid() != 0:
+            rc, out, err = run_cli(['enqueue', json.dumps({'command': 'echo x', 'nice': -5})])
+            assert rc != 0 and 'nice' in err
+        # the worker's limits are ceilings a job can only tighten
+        merged = worker.func_merge_limits({'memory_mb': 4096, 'cpu_seconds': 10, 'nice': 1, 'cpu_affinity': [0, 1]},
+                                          {'memory_mb': 2048, 'cpu_seconds': 60, 'nice': 5, 'cpu_affinity': [1, 2]})
+        assert merged == {'memory_mb': 2048, 'cpu_seconds': 10, 'nice': 5, 'cpu_affinity': [1]}
+        assert worker.func_cache_key('echo x', {'memory_mb': 128}) != worker.func_cache_key('echo x')
+
     # 4) enqueue failing (dead after retries)
     print_section('enqueue failing')
     payload = '{"command":"python -c \\\"import sys; sys.exit(2)\\\"","max_retries":2}'
@@ -88,6 +183,24 @@ def main():
     # It will likely go dead again; wait briefly for it to settle
     wait_for(lambda: (read_job(bad_id) or [None, None, ''])[2] in ('pending', 'processing', 'dead', 'completed'), 3.0)
 
+    # 5b) bulk dlq: filtered dry-run, export and purge
+    print_section('dlq bulk ops')
+    bulk_ids = []
+    for _ in range(2):
+        rc, out, err = run_cli(['enqueue', '{"command":"python -c \\\"import sys; sys.exit(3)\\\"","max_retries":1}'])
+        bulk_ids.append(int(out.strip().split()[-1]))
+    for jid in bulk_ids:
+        assert wait_for(lambda jid=jid: (read_job(jid) or [None, None, ''])[2] == 'dead', 5.0)
+    rc, out, err = run_cli(['dlq', 'retry', '--match', '*exit(3)*', '--dry-run'])
+    assert rc == 0 and 'would retry 2 jobs' in out, out + err
+    rc, out, err = run_cli(['dlq', 'export', '--match', '*exit(3)*'])
+    assert rc == 0 and sorted(int(json.loads(l)['id']) for l in out.strip().splitlines()) == sorted(bulk_ids)
+    rc, out, err = run_cli(['dlq', 'purge'])
+    assert rc != 0
+    rc, out, err = run_cli(['dlq', 'purge', '--match', '*exit(3)*'])
+    assert rc == 0 and 'purged 2 jobs' in out
+    assert all(read_job(jid) is None for jid in bulk_ids)
+
     # 6) list by states
     print_section('list states')
     rc, out, err = run_cli(['list', '--state', 'pending'])
@@ -106,6 +219,21 @@ def main():
     rc, out, err = run_cli(['history', '--job-id', str(ok_id)])
     assert rc == 0 and str(ok_id) in out
 
+    # 7b) event timeline: coded events with numeric details, read through the job index
+    print_section('history events')
+    rc, out, err = run_cli(['history', '--events', '--job-id', str(ok_id), '--order', 'asc'])
+    assert rc == 0, err
+    timeline = [json.loads(line) for line in out.strip().splitlines()]
+    assert [e['event'] for e in timeline][:1] == ['enqueued'] and timeline[-1]['event'] == 'completed'
+    processing = [e for e in timeline if e['event'] == 'processing']
+    assert processing and processing[0]['attempt'] == 1 and processing[0]['worker']
+    rc, out, err = run_cli(['history', '--events', '--job-id', str(bad_id)])
+    assert rc == 0 and '"retry_scheduled"' in out and '"delay"' in out
+    conn, cur = storage.connect_db(storage.shard_for_job(ok_id))
+    cur.execute('EXPLAIN QUERY PLAN SELECT id FROM events WHERE job_id = ? ORDER BY created_at', (ok_id,))
+    assert 'idx_events_job_created' in ' '.join(str(r) for r in cur.fetchall())
+    conn.close()
+
     # 8) parallelism check: 3 jobs with 2 workers should finish in ~<=4s
     print_section('parallelism')
     ids = []
@@ -118,6 +246,106 @@ def main():
     duration = time.time() - start
     print(f'parallel jobs finished in ~{duration:.1f}s')
 
+    # 8b) online backup and export/import into a fresh database, while workers run
+    print_section('backup and export/import')
+    tmp = tempfile.mkdtemp()
+    try:
+        # a writer keeps committing during the backup; the backup still finishes with a consistent copy
+        stop = threading.Event()
+        written = []
+
+        def writer():
+            while not stop.is_set():
+                written.append(storage.add_job('echo backup-load', state='completed'))
+
+        wt = threading.Thread(target=writer, daemon=True)
+        wt.start()
+        assert wait_for(lambda: len(written) >= 20, 5.0, 0.01)
+        rc, out, err = run_cli(['backup', os.path.join(tmp, 'backup.db')])
+        assert wait_for(lambda: len(written) >= 40, 5.0, 0.01)
+        stop.set()
+        wt.join(5.0)
+        assert rc == 0, err
+        assert all(written) and not os.path.exists(os.path.join(tmp, 'backup.db.partial'))
+        conn = sqlite3.connect(os.path.join(tmp, 'backup.db'))
+        assert conn.execute('PRAGMA integrity_check').fetchone()[0] == 'ok'
+        assert conn.execute('SELECT COUNT(*) FROM jobs WHERE id=?', (ok_id,)).fetchone()[0] == 1
+        copied = conn.execute("SELECT COUNT(*) FROM jobs WHERE command='echo backup-load'").fetchone()[0]
+        assert 20 <= copied < len(written), (copied, len(written))
+        conn.close()
+        # the queue runs in WAL mode, so a commit during a (slowed down) backup does not wait for the copy
+        live_connect = storage.connect_db
+
+        def slow_connect(shard=0):
+            conn, cur = live_connect(shard)
+            if threading.current_thread() is bt:
+                conn.set_progress_handler(lambda: time.sleep(0.01), 10)
+            return conn, cur
+
+        storage.connect_db = slow_connect
+        try:
+            bt = threading.Thread(target=storage.backup, args=(os.path.join(tmp, 'slow.db'),), daemon=True)
+            started = time.time()
+            bt.start()
+            time.sleep(0.2)
+            t0 = time.time()
+            assert storage.add_job('echo during-backup', state='completed')
+            write_time = time.time() - t0
+            bt.join(30.0)
+            backup_time = time.time() - started
+        finally:
+            storage.connect_db = live_connect
+        assert not bt.is_alive() and os.path.exists(os.path.join(tmp, 'slow.db'))
+        assert backup_time > 1.0 and write_time < 0.5, (backup_time, write_time)
+        rc, out, err = run_cli(['export', '--output', os.path.join(tmp, 'queue.jsonl')])
+        assert rc == 0, err
+        with open(os.path.join(tmp, 'queue.jsonl')) as f:
+            exported = [json.loads(line) for line in f]
+        assert ok_id in [r['id'] for r in exported]
+        importer = [sys.executable, os.path.abspath('queuectl.py'), 'import', 'queue.jsonl']
+        proc = subprocess.run(importer, capture_output=True, text=True, cwd=tmp)
+        assert proc.returncode == 0 and f'imported {len(exported)} jobs' in proc.stdout, proc.stdout + proc.stderr
+        proc = subprocess.run(importer, capture_output=True, text=True, cwd=tmp)
+        assert 'imported 0 jobs' in proc.stdout
+        proc = subprocess.run([sys.executable, os.path.abspath('queuectl.py'), 'history', '--events', '--job-id', str(ok_id)],
+                              capture_output=True, text=True, cwd=tmp)
+        assert '"completed"' in proc.stdout
+        # an id held by a different job is a conflict, not "already present"
+        with open(os.path.join(tmp, 'conflict.jsonl'), 'w') as f:
+            f.write(json.dumps({'id': ok_id, 'command': 'echo something else'}) + '\n')
+        proc = subprocess.run(importer[:-1] + ['conflict.jsonl'], capture_output=True, text=True, cwd=tmp)
+        assert proc.returncode != 0 and '1 conflicts' in proc.stdout and str(ok_id) in proc.stderr, proc.stdout + proc.stderr
+        # into two shards: jobs with an external id go to the shard their key hashes to,
+        # with new ids where needed, and dependency edges follow the new ids
+        sharded = os.path.join(tmp, 'sharded')
+        os.mkdir(sharded)
+        subprocess.run(importer[:-2] + ['config', 'set', 'shards', '2'], capture_output=True, text=True, cwd=sharded)
+        # a blocked pair whose exported ids sit in the wrong shard for their external ids
+        pair = [{'id': 1000000 + (1 - zlib.crc32(ext.encode()) % 2) + 2 * i, 'external_id': ext} for i, ext in enumerate(('imp-up', 'imp-down'))]
+        pair[0].update(command='echo up', state='pending', dependents=[pair[1]['id']])
+        pair[1].update(command='echo down', state='blocked', remaining_deps=1,
+                       events=[{'event': 'ready', 'upstream': pair[0]['id'], 'created_at': '2025-01-01 00:00:00'}])
+        exported += pair
+        with open(os.path.join(tmp, 'queue.jsonl'), 'a') as f:
+            f.writelines(json.dumps(r) + '\n' for r in pair)
+        proc = subprocess.run(importer[:-1] + [os.path.join(tmp, 'queue.jsonl')], capture_output=True, text=True, cwd=sharded)
+        assert proc.returncode == 0 and f'imported {len(exported)} jobs' in proc.stdout, proc.stdout + proc.stderr
+        files = [sqlite3.connect(os.path.join(sharded, name)) for name in ('queuectl.db', 'queuectl.1.db')]
+        placed = {}
+        for shard, conn in enumerate(files):
+            for job_id, ext in conn.execute('SELECT id, external_id FROM jobs WHERE external_id IS NOT NULL'):
+                assert job_id % 2 == shard == zlib.crc32(ext.encode()) % 2
+                placed[ext] = job_id
+        assert sorted(placed) == sorted(r['external_id'] for r in exported if r.get('external_id'))
+        up, down = placed['imp-up'], placed['imp-down']
+        assert (up, down) != (pair[0]['id'], pair[1]['id'])
+        assert files[up % 2].execute('SELECT job_id FROM job_deps WHERE depends_on=?', (up,)).fetchall() == [(down,)]
+        assert files[down % 2].execute('SELECT upstream FROM events WHERE job_id=?', (down,)).fetchall() == [(up,)]
+        for conn in files:
+            conn.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
     # 9) status prints
     print_section('status')
     rc, out, err = run_cli(['status'])
@@ -128,6 +356,214 @@ def main():
     rc, out, err = run_cli(['worker', 'stop'])
     assert rc == 0
     assert wait_for(lambda: storage.count_active_workers(10) == 0, 5.0)
+
+    # 11) broker mode on localhost: enqueue and work through tcp only
+    print_section('broker')
+    server, _, (host, port) = broker.func_start_background_broker('127.0.0.1', 0, lease_seconds=5)
+    addr = f'{host}:{port}'
+    broker.BrokerClient(host, port).set_config('workers_should_stop', '0')
+    bt, bwid = broker.func_start_background_broker_worker((host, port), poll_interval=0.2, batch_size=2, lease_seconds=5)
+    assert wait_for(lambda: storage.count_active_workers(10) >= 1, 3.0)
+    ids = []
+    for _ in range(3):
+        rc, out, err = run_cli(['enqueue', '--broker', addr, '{"command":"python -c \\\"print(1)\\\""}'])
+        assert rc == 0 and out.strip().startswith('enqueued '), err
+        ids.append(int(out.strip().split()[-1]))
+    for jid in ids:
+        assert wait_for(lambda jid=jid: (read_job(jid) or [None, None, ''])[2] == 'completed', 5.0)
+    rc, out, err = run_cli(['worker', 'stop', '--broker', addr])
+    assert rc == 0
+    assert wait_for(lambda: storage.count_active_workers(10) == 0, 5.0)
+    server.shutdown()
+    server.server_close()
+    # a non-loopback bind needs a token, and a token-protected broker rejects requests without it
+    try:
+        broker.BrokerServer(('0.0.0.0', 0))
+        assert False, 'bound 0.0.0.0 without a token'
+    except ValueError:
+        pass
+    server, _, (host, port) = broker.func_start_background_broker('127.0.0.1', 0, token='s3cret')
+    try:
+        broker.BrokerClient(host, port).stats()
+        assert False, 'request without a token was served'
+    except broker.BrokerError:
+        pass
+    assert 'pending' in broker.BrokerClient(host, port, token='s3cret').stats()
+    server.shutdown()
+    server.server_close()
+    # a reply that never comes is an error and the request is not sent twice; a
+    # connection the broker closed while idle is reopened before sending
+    listener = socket.create_server(('127.0.0.1', 0))
+    received = []
+
+    def fake_broker(conn, answer):
+        with conn:
+            for line in conn.makefile('rb'):
+                received.append(json.loads(line)['op'])
+                if answer:
+                    conn.sendall(b'{"ok": true, "pending": 0}\n')
+                    return
+
+    def accept_all(answer):
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=fake_broker, args=(conn, answer), daemon=True).start()
+
+    threading.Thread(target=accept_all, args=(False,), daemon=True).start()
+    silent = broker.BrokerClient(*listener.getsockname(), timeout=0.5)
+    try:
+        silent.enqueue('echo once')
+        assert False, 'a lost reply was not reported'
+    except OSError:
+        pass
+    time.sleep(0.3)
+    assert received == ['enqueue'], received
+    listener.close()
+    listener = socket.create_server(('127.0.0.1', 0))
+    received.clear()
+    threading.Thread(target=accept_all, args=(True,), daemon=True).start()
+    client = broker.BrokerClient(*listener.getsockname(), timeout=2.0)
+    assert client.stats()['pending'] == 0
+    time.sleep(0.2)
+    assert client.stats()['pending'] == 0
+    assert received == ['stats', 'stats'], received
+    client.close()
+    listener.close()
+
+    # 12) in-memory backend behind the broker: nothing touches sqlite
+    print_section('memory backend')
+    mem = backends.MemoryBackend()
+    on_disk = storage.counts_by_state()
+    server, _, (host, port) = broker.func_start_background_broker('127.0.0.1', 0, lease_seconds=5, backend=mem)
+    client = broker.BrokerClient(host, port)
+    bt, bwid = broker.func_start_background_broker_worker((host, port), poll_interval=0.05, batch_size=8, lease_seconds=5)
+    ids = [client.enqueue('exit 0') for _ in range(20)]
+    bad = client.enqueue('exit 3', max_retries=1)
+    assert wait_for(lambda: mem.counts_by_state()['completed'] == 20, 10.0)
+    assert wait_for(lambda: (mem.get_job(bad) or [None, None, ''])[2] == 'dead', 5.0)
+    assert storage.counts_by_state() == on_disk
+    client.set_config('workers_should_stop', '1')
+    bt.join(5.0)
+    assert not bt.is_alive() and mem.count_active_workers(10) == 0
+    # complete/fail from a worker that does not hold the lease are rejected
+    leased = client.enqueue('exit 0')
+    assert [j['id'] for j in client.claim('w-a')] == [leased]
+    for call in (lambda: client.complete('w-b', leased), lambda: client.fail('w-b', leased, 1, dead=True)):
+        try:
+            call()
+            assert False, 'foreign worker finished a leased job'
+        except broker.BrokerError:
+            pass
+    assert mem.get_job(leased)[2] == 'processing'
+    client.complete('w-a', leased)
+    assert mem.get_job(leased)[2] == 'completed'
+    # unstarted jobs of a batch can be handed back, but only by their lease holder
+    pair = [client.enqueue('exit 0'), client.enqueue('exit 0')]
+    assert sorted(j['id'] for j in client.claim('w-a', 2)) == sorted(pair)
+    assert client.release('w-b', pair) == 0
+    assert client.release('w-a', pair[1:]) == 1
+    assert [mem.get_job(i)[2] for i in pair] == ['processing', 'pending']
+    client.complete('w-a', pair[0])
+    client.complete('w-a', client.claim('w-a')[0]['id'])
+    # a heartbeat only renews the jobs the worker says it holds
+    kept, lost = client.enqueue('exit 0'), client.enqueue('exit 0')
+    assert sorted(j['id'] for j in client.claim('w-a', 2, lease=1)) == [kept, lost]
+    client.heartbeat('w-a', lease=60, job_ids=[kept])
+    time.sleep(1.2)
+    assert [j['id'] for j in client.claim('w-b', 2)] == [lost]
+    assert mem.get_job(kept)[2] == 'processing'
+    # the broker validates cache_ttl like the cli does
+    try:
+        client.enqueue_many([{'command': 'echo x', 'cache_ttl': 'soon'}])
+        assert False, 'broker accepted a bad cache_ttl'
+    except broker.BrokerError as e:
+        assert 'cache_ttl' in str(e)
+    try:
+        client.enqueue_many([{'command': 'echo x', 'depends_on': 5}])
+        assert False, 'broker accepted a bad depends_on'
+    except broker.BrokerError as e:
+        assert 'depends_on' in str(e)
+    # both backends report the same cache fields, hits are the hits on the current entries
+    mem.cache_clear()
+    mem.cache_put('k', 0, 'out', 60)
+    assert mem.cache_get('k') == (0, 'out') and mem.cache_get('missing') is None
+    assert mem.cache_stats()['hits'] == 1 and set(mem.cache_stats()) == set(storage.cache_stats())
+    # the cli refuses a process-local backend outside serve
+    proc = subprocess.run([sys.executable, 'queuectl.py', 'status'], capture_output=True, text=True,
+                          env=dict(os.environ, QUEUECTL_BACKEND='memory'))
+    assert proc.returncode != 0 and 'process-local' in proc.stderr
+    server.shutdown()
+    server.server_close()
+
+    # 13) autoscaling: a backlog grows the pool, an empty queue shrinks it back to min
+    print_section('autoscale')
+    mem = backends.MemoryBackend()
+    mem.set_config('workers_should_stop', '0')
+    for _ in range(40):
+        mem.add_job('python -c "import time; time.sleep(0.2)"')
+    scaler = worker.Autoscaler(
+        lambda stop_event, stats: worker.func_start_background_worker(0.05, backend=mem, stop_event=stop_event, stats=stats),
+        mem.count_pending, min_workers=1, max_workers=4, interval=0.3, up_after=1, down_after=2, max_load=100.0,
+    )
+    st = threading.Thread(target=scaler.run, args=(lambda: mem.get_config('workers_should_stop') == '1',), daemon=True)
+    st.start()
+    assert wait_for(lambda: scaler.size() > 1, 3.0)
+    assert wait_for(lambda: mem.counts_by_state()['completed'] == 40, 15.0)
+    assert wait_for(lambda: scaler.size() == 1, 5.0)
+    mem.set_config('workers_should_stop', '1')
+    st.join(5.0)
+    assert not st.is_alive()
+
+    # 14) shards: separate cli enqueues spread over the files, and a running process sees a new shard count
+    print_section('shards')
+    tmp = tempfile.mkdtemp()
+    live_db = storage.dp_path
+    try:
+        storage.dp_path = os.path.join(tmp, 'queuectl.db')
+        storage._shards = None
+        storage.make_db()
+        assert storage.shard_count() == 1
+        cli = [sys.executable, os.path.abspath('queuectl.py')]
+        proc = subprocess.run(cli + ['config', 'set', 'shards', '4'], capture_output=True, text=True, cwd=tmp)
+        assert proc.returncode == 0, proc.stderr
+        assert wait_for(lambda: storage.shard_count() == 4, storage.SHARDS_REFRESH + 2.0)
+        for _ in range(24):
+            proc = subprocess.run(cli + ['enqueue', '{"command":"echo x"}'], capture_output=True, text=True, cwd=tmp)
+            assert proc.returncode == 0, proc.stderr
+        per_shard = []
+        for shard in range(4):
+            conn, cur = storage.connect_db(shard)
+            cur.execute('SELECT id FROM jobs')
+            ids = [row[0] for row in cur.fetchall()]
+            conn.close()
+            assert all(jid % 4 == shard for jid in ids)
+            per_shard.append(len(ids))
+        assert sum(per_shard) == 24 and sum(1 for n in per_shard if n) >= 3, per_shard
+
+        # purging leaves old sequences behind; after a reshard new ids still land in their own shard
+        os.makedirs(os.path.join(tmp, 'purged'))
+        storage.dp_path = os.path.join(tmp, 'purged', 'queuectl.db')
+        storage._shards = None
+        storage.make_db()
+        for _ in range(5):
+            storage.add_job('echo old', state='dead')
+        assert storage.purge_dead(match='*') == 5
+        storage.set_shard_count(3)
+        ids = [jid for jid, _ in storage.add_jobs([{'command': f'echo {i}'} for i in range(9)])]
+        assert len(set(ids)) == 9, ids
+        for jid in ids:
+            conn, cur = storage.connect_db(jid % 3)
+            cur.execute('SELECT COUNT(*) FROM jobs WHERE id=?', (jid,))
+            assert cur.fetchone()[0] == 1, (jid, ids)
+            conn.close()
+            assert storage.get_job(jid)[0] == jid
+    finally:
+        storage.dp_path = live_db
+        storage._shards = None
+        shutil.rmtree(tmp, ignore_errors=True)
     print('all tests passed')
 
 
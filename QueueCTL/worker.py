@@ -6,116 +6,286 @@ import time
 import subprocess
 import os
 import uuid
-import storage
+import math
+import hashlib
+import json
+import backends
 from queue import Queue
 
+# resource limits need the posix resource module (not available on windows)
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# the job lifecycle goes through the configured storage backend (see backends.py);
+# these wrappers keep the original worker api
 
 # function to get the next job and mark it as processing
-def func_next_job():
-    storage.make_db()
-    conn, cur = storage.connect_db()
-    try:
-        cur.execute('BEGIN IMMEDIATE')
-        cur.execute(
-            "SELECT id, command, attempts, max_retires FROM jobs WHERE state='pending' ORDER BY created_at LIMIT 1"
-        )
-        row = cur.fetchone()
-        if not row:
-            conn.commit()
-            return None
-        job_id, command, attempts, max_retires = row
-        cur.execute(
-            "UPDATE jobs SET state='processing', updated_at=CURRENT_TIMESTAMP WHERE id=? AND state='pending'",
-            (job_id,),
-        )
-        if cur.rowcount != 1:
-            conn.rollback()
-            return None
-        conn.commit()
-        return {
-            'id': job_id,
-            'command': command,
-            'attempts': attempts,
-            'max_retires': max_retires,
-        }
-    except Exception:
-        try:
-            conn.rollback()
-        except Exception:
-            pass
-        return None
-    finally:
-        conn.close()
+def func_next_job(shard_hint: int = 0, backend=None):
+    return (backend or backends.get_backend()).next_job(shard_hint)
 
 
-# function for marking the job as completed
-def func_mark_complete(job_id: int):
+# function to claim up to `limit` pending jobs for a worker under a lease
+def func_claim_jobs(worker_id: str, limit: int = 1, lease_seconds: int = 30, shard_hint: int = 0, backend=None):
+    return (backend or backends.get_backend()).claim_jobs(worker_id, limit, lease_seconds, shard_hint)
 
-    conn, cur = storage.connect_db()
-    try:
-        cur.execute(
-            "UPDATE jobs SET state='completed', updated_at=CURRENT_TIMESTAMP WHERE id=?",
-            (job_id,),
-        )
-        conn.commit()
-    finally:
-        conn.close()
 
+# function to extend the leases of the jobs a worker holds
+def func_extend_leases(worker_id: str, job_ids, lease_seconds: int = 30, backend=None):
+    return (backend or backends.get_backend()).extend_leases(worker_id, job_ids, lease_seconds)
 
-# function for marking the job as dead
-def func_mark_dead(job_id: int):
 
-    conn, cur = storage.connect_db()
-    try:
-        cur.execute(
-            "UPDATE jobs SET state='dead', updated_at=CURRENT_TIMESTAMP WHERE id=?",
-            (job_id,),
-        )
-        conn.commit()
-    finally:
-        conn.close()
+# function for marking the job as completed
+def func_mark_complete(job_id: int, backend=None):
+    (backend or backends.get_backend()).mark_complete(job_id)
+
+
+# function for marking the job as dead
+def func_mark_dead(job_id: int, backend=None):
+    (backend or backends.get_backend()).mark_dead(job_id)
 
 
 # function for requeuing the job with the next attempt
-def func_requeue_with_attempt(job_id: int, next_attempts: int):
-    conn, cur = storage.connect_db()
-    try:
-        cur.execute(
-            "UPDATE jobs SET state='pending', attempts=?, updated_at=CURRENT_TIMESTAMP WHERE id=?",
-            (next_attempts, job_id),
-        )
-        conn.commit()
-    finally:
-        conn.close()
+def func_requeue_with_attempt(job_id: int, next_attempts: int, backend=None):
+    (backend or backends.get_backend()).requeue_with_attempt(job_id, next_attempts)
 
 
 # function for executing the command
-def func_execute_command(command: str) -> bool:
+def func_execute_command(command: str, limits: dict | None = None) -> bool:
+    return func_run_command(command, limits)[0] == 0
+
+
+OUTPUT_TAIL_BYTES = 4096
+
+
+# function for executing the command and keeping its exit code and the tail of its output
+# limits (see func_parse_limits) are applied to the child before the command starts
+def func_run_command(command: str, limits: dict | None = None):
     cmd = (command or '').strip()
     if len(cmd) >= 2 and ((cmd[0] == cmd[-1] == '"') or (cmd[0] == cmd[-1] == "'")):
         cmd = cmd[1:-1]
     try:
-        result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return result.returncode == 0
-    except Exception:
-        return False
+        result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                preexec_fn=func_limits_preexec(limits))
+        return result.returncode, result.stdout[-OUTPUT_TAIL_BYTES:].decode(errors='replace')
+    except Exception as e:
+        # e.g. a limit the child could not apply (a cpu that does not exist)
+        return -1, str(e)
+
+
+# resource limits of a job or a worker, all optional:
+# cpu_affinity: cpus the command may run on, a list or a string like "0-3,6"
+# nice: niceness increment (positive lowers the priority, negative needs root)
+# memory_mb: address space limit (RLIMIT_AS)
+# cpu_seconds: cpu time limit (RLIMIT_CPU), the command is killed when it is used up
+LIMIT_KEYS = ('cpu_affinity', 'nice', 'memory_mb', 'cpu_seconds')
+
+
+# function to check the limits in a job/worker spec; returns a dict with the set ones or None
+def func_parse_limits(spec) -> dict | None:
+    limits = {}
+    for key in LIMIT_KEYS:
+        value = (spec or {}).get(key)
+        if value is None or value == '':
+            continue
+        if key == 'cpu_affinity':
+            value = func_parse_cpus(value)
+        else:
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise ValueError(f'{key} must be an integer')
+            if key != 'nice' and value <= 0:
+                raise ValueError(f'{key} must be positive')
+            if key == 'nice' and value < 0 and not _privileged():
+                raise ValueError('nice below 0 needs root')
+        limits[key] = value
+    return limits or None
+
+
+def _privileged() -> bool:
+    return not hasattr(os, 'geteuid') or os.geteuid() == 0
+
+
+# function to combine a job's limits with its worker's: the worker's are ceilings
+# a job can tighten but not loosen (the lower memory_mb and cpu_seconds, the higher
+# nice, the cpus both allow; a job asking only for cpus outside the worker's set
+# runs on the worker's set)
+def func_merge_limits(job_limits: dict | None, worker_limits: dict | None) -> dict:
+    limits = dict(worker_limits or {})
+    for key, value in (job_limits or {}).items():
+        ceiling = limits.get(key)
+        if ceiling is None:
+            limits[key] = value
+        elif key == 'cpu_affinity':
+            limits[key] = sorted(set(value) & set(ceiling)) or ceiling
+        elif key == 'nice':
+            limits[key] = max(value, ceiling)
+        else:
+            limits[key] = min(value, ceiling)
+    return limits
+
+
+# function to turn "0-3,6", 2 or [0, 1] into a sorted list of cpu numbers
+def func_parse_cpus(value) -> list:
+    try:
+        if isinstance(value, int):
+            cpus = {value}
+        elif isinstance(value, str):
+            cpus = set()
+            for part in value.split(','):
+                if part.strip():
+                    lo, _, hi = part.partition('-')
+                    cpus.update(range(int(lo), int(hi or lo) + 1))
+        else:
+            cpus = {int(c) for c in value}
+    except (TypeError, ValueError):
+        raise ValueError(f'invalid cpu_affinity {value!r}')
+    if not cpus or min(cpus) < 0:
+        raise ValueError(f'invalid cpu_affinity {value!r}')
+    return sorted(cpus)
+
+
+# function for the preexec_fn that applies limits in the child between fork and
+# exec, so the command and everything it starts inherit them. settings the
+# platform lacks (affinity outside linux, rlimits without `resource`) are skipped.
+# the workers are threads, and after a fork only the forking thread exists: a lock
+# another thread held at that moment (the import lock, logging, stdio) stays locked
+# forever in the child. so everything is worked out here in the parent, and apply()
+# only makes the bare syscalls: no imports, no allocation-heavy work, no i/o
+def func_limits_preexec(limits: dict | None):
+    if not limits or os.name != 'posix':
+        return None
+    affinity = limits.get('cpu_affinity') if hasattr(os, 'sched_setaffinity') else None
+    affinity = set(affinity) if affinity else None
+    nice = limits.get('nice')
+    rlimits = []
+    if resource is not None:
+        if limits.get('memory_mb'):
+            rlimits.append(_rlimit(resource.RLIMIT_AS, limits['memory_mb'] * 1024 * 1024))
+        if limits.get('cpu_seconds'):
+            rlimits.append(_rlimit(resource.RLIMIT_CPU, limits['cpu_seconds']))
+
+    def apply():
+        if affinity:
+            os.sched_setaffinity(0, affinity)
+        if nice:
+            os.nice(nice)
+        for which, value in rlimits:
+            resource.setrlimit(which, value)
+
+    return apply
+
+
+# the hard limit is lowered too, so the command can't raise it again
+def _rlimit(which, value):
+    hard = resource.getrlimit(which)[1]
+    if hard != resource.RLIM_INFINITY:
+        value = min(value, hard)
+    return which, (value, value)
+
+
+# hands out cpus for `worker start --pin`: a job gets the allowed cpu with the
+# fewest pinned jobs running, so the concurrent jobs of a pool spread over the cores
+class CorePinner:
+
+    def __init__(self, cpus=None):
+        if not cpus:
+            cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else range(os.cpu_count() or 1)
+        self._lock = threading.Lock()
+        self._running = {cpu: 0 for cpu in cpus}
+
+    def acquire(self) -> int:
+        with self._lock:
+            cpu = min(self._running, key=self._running.get)
+            self._running[cpu] += 1
+            return cpu
+
+    def release(self, cpu: int):
+        with self._lock:
+            self._running[cpu] -= 1
+
+
+# function for running a job's command within its worker's limits (func_merge_limits),
+# and with a pinner a job without its own cpu_affinity gets one cpu for itself
+def func_run_job(command: str, job_limits: dict | None = None, worker_limits: dict | None = None, pinner=None):
+    limits = func_merge_limits(job_limits, worker_limits)
+    cpu = None
+    if pinner is not None and not (job_limits or {}).get('cpu_affinity'):
+        cpu = pinner.acquire()
+        limits['cpu_affinity'] = [cpu]
+    try:
+        return func_run_command(command, limits)
+    finally:
+        if cpu is not None:
+            pinner.release(cpu)
+
+
+# environment variables that take part in the result cache key; the rest of the
+# worker's environment (secrets, session ids, the working directory) does not
+CACHE_ENV = ('PATH', 'HOME', 'LANG', 'LC_ALL', 'TZ', 'PYTHONPATH', 'VIRTUAL_ENV')
+
+
+# function for the result cache key of a command: the same command with the same
+# CACHE_ENV variables and the same limits is expected to give the same result
+def func_cache_key(command: str, limits: dict | None = None) -> str:
+    h = hashlib.sha256()
+    h.update((command or '').strip().encode())
+    for k in CACHE_ENV:
+        h.update(b'\0' + k.encode() + b'=' + os.environ.get(k, '').encode())
+    if limits:
+        h.update(b'\0' + json.dumps(limits, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+# function to check a job's cache_ttl; returns a positive number of seconds or None
+def func_parse_cache_ttl(value) -> int | None:
+    if value is None or value == '':
+        return None
+    try:
+        ttl = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'cache_ttl must be an integer, got {value!r}')
+    if ttl <= 0:
+        raise ValueError('cache_ttl must be positive')
+    return ttl
+
+
+# function to check a job's depends_on; returns a list of job ids and external ids
+def func_parse_depends_on(value) -> list:
+    if value is None:
+        return []
+    if not isinstance(value, list) or not all(isinstance(d, (int, str)) and not isinstance(d, bool) for d in value):
+        raise ValueError(f'depends_on must be a list of job ids or external ids, got {value!r}')
+    return value
 
 
 # function for the worker loop
-def worker_loop(poll_interval: float = 1.0, backoff_base: int = 2, worker_id: str | None = None):
-    storage.make_db()
+# stop_event retires just this worker: it finishes its current job and exits
+# stats (a WorkerStats shared by a pool) counts busy workers and finished jobs
+def worker_loop(poll_interval: float = 1.0, backoff_base: int = 2, worker_id: str | None = None, backend=None,
+                stop_event: threading.Event | None = None, stats=None, limits: dict | None = None, pinner=None):
+    backend = backend or backends.get_backend()
+    backend.make_db()
     # generating a unique worker id
     worker_id = worker_id or f"{os.getpid()}-{uuid.uuid4().hex[:6]}-{threading.get_ident()}"
-    storage.register_worker(worker_id, os.getpid())
+    worker_num = backend.register_worker(worker_id, os.getpid())
+    # each worker starts its claims at its own shard so workers spread over the files
+    home_shard = backend.shard_for_key(worker_id)
     while True:
-        storage.timestamp_worker(worker_id, 'running')
+        if stop_event is not None and stop_event.is_set():
+            backend.timestamp_worker(worker_id, 'stopped')
+            break
+        backend.timestamp_worker(worker_id, 'running')
         # Check global stop flag from config; if set, finish pending work and exit when idle
-        stop_flag = storage.get_config('workers_should_stop', '0') == '1'
+        stop_flag = backend.get_config('workers_should_stop', '0') == '1'
         # getting the next job from the database
-        job = func_next_job()
+        job = backend.next_job(home_shard)
         if not job:
             if stop_flag:
-                storage.timestamp_worker(worker_id, 'stopped')
+                backend.timestamp_worker(worker_id, 'stopped')
                 break
             time.sleep(poll_interval)
             continue
@@ -127,17 +297,38 @@ def worker_loop(poll_interval: float = 1.0, backoff_base: int = 2, worker_id: st
         max_retires = int(job['max_retires'] or 3)
 
         # executing the command
+        if stats:
+            stats.job_started(worker_id)
+        # an identical job finished successfully within cache_ttl: complete it from the cache
+        cache_ttl = job.get('cache_ttl')
+        cache_key = func_cache_key(command, func_merge_limits(job.get('limits'), limits)) if cache_ttl else None
+        cached = backend.cache_get(cache_key) if cache_key else None
+        if cached:
+            backend.mark_complete(job_id)
+            if stats:
+                stats.job_finished(worker_id)
+            print(f"worker {worker_id} completed job {job_id} from cache")
+            try:
+                backend.add_event(job_id, 'cache_hit', worker=worker_num, attempt=attempts + 1, exit_code=cached[0])
+            except Exception:
+                pass
+            continue
         print(f"worker {worker_id} processing job {job_id} (attempt {attempts + 1}/{max_retires})")
         try:
-            storage.add_event(job_id, 'processing', f'worker={worker_id}')
+            backend.add_event(job_id, 'processing', worker=worker_num, attempt=attempts + 1)
         except Exception:
             pass
-        result = func_execute_command(command)
+        exit_code, output = func_run_job(command, job.get('limits'), limits, pinner)
+        result = exit_code == 0
+        if result and cache_key:
+            backend.cache_put(cache_key, exit_code, output, int(cache_ttl))
         if result:
-            func_mark_complete(job_id)
+            backend.mark_complete(job_id)
+            if stats:
+                stats.job_finished(worker_id)
             print(f"worker {worker_id} completed job {job_id}")
             try:
-                storage.add_event(job_id, 'completed', None)
+                backend.add_event(job_id, 'completed', exit_code=exit_code)
             except Exception:
                 pass
             continue
@@ -145,16 +336,18 @@ def worker_loop(poll_interval: float = 1.0, backoff_base: int = 2, worker_id: st
         # if the command failed, then we are marking the job as dead only if the attempts are greater than or equal to the max_retires
         next_attempts = attempts + 1
         if next_attempts >= max_retires:
-            func_mark_dead(job_id)
+            backend.mark_dead(job_id)
+            if stats:
+                stats.job_finished(worker_id)
             print(f"worker {worker_id} moved job {job_id} to DLQ")
             try:
-                storage.add_event(job_id, 'dead', None)
+                backend.add_event(job_id, 'dead', attempt=next_attempts, exit_code=exit_code)
             except Exception:
                 pass
             continue
 
         # getting the backoff value from the config
-        cfg_backoff = storage.get_config('backoff', None)
+        cfg_backoff = backend.get_config('backoff', None)
         # if the backoff value is not found, then we are using the default backoff value
         base = int(cfg_backoff) if cfg_backoff is not None else backoff_base
         # calculating the delay
@@ -162,16 +355,20 @@ def worker_loop(poll_interval: float = 1.0, backoff_base: int = 2, worker_id: st
         print(f"worker {worker_id} retrying job {job_id} in {delay}s (attempt {next_attempts}/{max_retires})")
         # sleeping for the delay to avoid duplicate processing
         time.sleep(delay)
-        func_requeue_with_attempt(job_id, next_attempts)
+        backend.requeue_with_attempt(job_id, next_attempts)
+        if stats:
+            stats.job_finished(worker_id)
         try:
-            storage.add_event(job_id, 'retry_scheduled', f'attempts={next_attempts}, delay={delay}')
+            backend.add_event(job_id, 'retry_scheduled', attempt=next_attempts, delay=delay, exit_code=exit_code)
         except Exception:
             pass
-        storage.timestamp_worker(worker_id, 'running')
+        backend.timestamp_worker(worker_id, 'running')
 
 
 # function for starting the background worker
-def func_start_background_worker(poll_interval: float = 1.0, backoff_base: int = 2):
+def func_start_background_worker(poll_interval: float = 1.0, backoff_base: int = 2, backend=None,
+                                 stop_event: threading.Event | None = None, stats=None,
+                                 limits: dict | None = None, pinner=None):
 
     # creating a new thread for the worker
     wid = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
@@ -179,7 +376,140 @@ def func_start_background_worker(poll_interval: float = 1.0, backoff_base: int =
         'poll_interval': poll_interval,
         'backoff_base': backoff_base,
         'worker_id': wid,
+        'backend': backend,
+        'stop_event': stop_event,
+        'stats': stats,
+        'limits': limits,
+        'pinner': pinner,
     }, daemon=True)
     t.start()
     return t, wid
 
+
+
+# counters shared by the workers of one pool
+class WorkerStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.done = 0
+        self.busy = set()
+
+    def job_started(self, worker_id: str):
+        with self._lock:
+            self.busy.add(worker_id)
+
+    def job_finished(self, worker_id: str):
+        with self._lock:
+            self.busy.discard(worker_id)
+            self.done += 1
+
+
+# function to get the 1 minute load average per cpu, or None where there is none
+def host_load() -> float | None:
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+# grows and shrinks a pool of worker threads between min_workers and max_workers.
+# every `interval` seconds it samples the pending depth, the pool's throughput and
+# the host load, and works out how many workers would drain the backlog within
+# `drain_seconds`. it only grows after `up_after` samples in a row ask for more and
+# only shrinks after `down_after` samples in a row ask for fewer (hysteresis), and
+# it shrinks one worker at a time by setting that worker's stop event, so the
+# worker finishes its current job before it exits. idle workers are retired first.
+class Autoscaler:
+
+    def __init__(self, start_worker, sample_pending, min_workers: int = 1, max_workers: int = 4,
+                 interval: float = 2.0, up_after: int = 2, down_after: int = 5,
+                 drain_seconds: float = 10.0, max_load: float = 1.0):
+        if min_workers < 0 or max_workers < max(min_workers, 1):
+            raise ValueError('need 0 <= min <= max and max >= 1')
+        # start_worker(stop_event, stats) -> (thread, worker_id)
+        self.start_worker = start_worker
+        self.sample_pending = sample_pending
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.up_after = up_after
+        self.down_after = down_after
+        self.drain_seconds = drain_seconds
+        self.max_load = max_load
+        self.stats = WorkerStats()
+        self.workers = []           # [thread, worker_id, stop_event]
+        self.rate = 0.0             # finished jobs per second, smoothed
+        self._last_done = 0
+        self._last_time = time.time()
+        self._want_more = 0
+        self._want_fewer = 0
+
+    # function to get the number of workers that are alive and not retiring
+    def size(self) -> int:
+        self.workers = [w for w in self.workers if w[0].is_alive()]
+        return sum(1 for w in self.workers if not w[2].is_set())
+
+    def grow(self, n: int = 1):
+        for _ in range(n):
+            stop_event = threading.Event()
+            t, wid = self.start_worker(stop_event, self.stats)
+            self.workers.append([t, wid, stop_event])
+            print(f"autoscale: started worker {wid}")
+
+    def shrink(self):
+        active = [w for w in self.workers if not w[2].is_set()]
+        if not active:
+            return
+        idle = [w for w in active if w[1] not in self.stats.busy]
+        victim = (idle or active)[-1]
+        victim[2].set()
+        print(f"autoscale: retiring worker {victim[1]}")
+
+    # function to work out the pool size the current sample asks for
+    def desired(self, pending: int, load: float | None) -> int:
+        current = self.size()
+        if load is not None and load > self.max_load:
+            # the host is saturated: more threads would only add contention
+            want = current - 1
+        elif pending == 0:
+            want = len(self.stats.busy)
+        else:
+            busy = max(len(self.stats.busy), 1)
+            per_worker = self.rate / busy
+            if per_worker > 0:
+                want = math.ceil(pending / (per_worker * self.drain_seconds))
+            else:
+                want = current + 1
+        return max(self.min_workers, min(self.max_workers, want))
+
+    # function to take one sample and resize the pool if the sample asks for it
+    def step(self):
+        now = time.time()
+        done = self.stats.done
+        elapsed = max(now - self._last_time, 1e-6)
+        self.rate = 0.5 * self.rate + 0.5 * ((done - self._last_done) / elapsed)
+        self._last_done, self._last_time = done, now
+
+        current = self.size()
+        want = self.desired(self.sample_pending(), host_load())
+        self._want_more = self._want_more + 1 if want > current else 0
+        self._want_fewer = self._want_fewer + 1 if want < current else 0
+        if self._want_more >= self.up_after:
+            self.grow(want - current)
+            self._want_more = 0
+        elif self._want_fewer >= self.down_after:
+            self.shrink()
+            self._want_fewer = 0
+
+    # function to run the control loop until should_stop() is true and the
+    # workers have drained (they exit on their own through workers_should_stop)
+    def run(self, should_stop):
+        self.grow(max(self.min_workers, 1 if self.min_workers == 0 and self.sample_pending() else 0))
+        while True:
+            time.sleep(self.interval)
+            if should_stop():
+                break
+            self.step()
+        for t, _, _ in self.workers:
+            t.join()